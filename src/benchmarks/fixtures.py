@@ -0,0 +1,137 @@
+"""
+Synthetic, seeded inputs for the benchmarks: Transcribe responses and face embedding streams
+shaped like the real ones, for media from a few minutes to several hours long.
+"""
+import random
+from typing import NamedTuple
+
+import numpy as np
+
+from faces.utils import Face, Person
+
+WORDS = ('el', 'la', 'de', 'que', 'y', 'en', 'un', 'ser', 'se', 'no', 'haber', 'por', 'con', 'su', 'para',
+         'como', 'estar', 'tener', 'le', 'lo', 'todo', 'pero', 'testigo', 'tribunal', 'señoría', 'abogado',
+         'declaración', 'juramento', 'pregunta', 'respuesta', 'defensa', 'fiscal', 'acusado', 'prueba')
+EMBEDDING_SIZE = 512
+
+
+class Size(NamedTuple):
+    name: str
+    # media duration in seconds
+    seconds: float
+
+
+SIZES = {
+    'small': Size('small', 5 * 60),
+    'medium': Size('medium', 30 * 60),
+    'large': Size('large', 3 * 60 * 60),
+}
+
+
+def transcript(seconds: float, speakers: int = 3, words_per_second: float = 2.5, seed: int = 0) -> dict:
+    """
+    Transcribe shaped response with speaker labels and punctuation
+    :param seconds: media duration
+    :param speakers:
+    :param words_per_second:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    items = []
+    segments = []
+    time = 0.0
+    speaker = 0
+    while time < seconds:
+        # a turn of one speaker, a few sentences long
+        label = f'spk_{speaker}'
+        segment_items = []
+        for _ in range(rng.randint(1, 6)):
+            for _ in range(rng.randint(4, 20)):
+                duration = rng.uniform(0.5, 1.5) / words_per_second
+                start_time, end_time = f'{time:.3f}', f'{time + duration:.3f}'
+                items.append({'type': 'pronunciation', 'start_time': start_time, 'end_time': end_time,
+                              'alternatives': [{'confidence': f'{rng.uniform(0.6, 1):.4f}',
+                                                'content': rng.choice(WORDS)}]})
+                segment_items.append({'start_time': start_time, 'end_time': end_time, 'speaker_label': label})
+                time += duration
+            items.append({'type': 'punctuation', 'alternatives': [{'confidence': '0.0', 'content': '.'}]})
+        segments.append({'start_time': segment_items[0]['start_time'], 'end_time': segment_items[-1]['end_time'],
+                         'speaker_label': label, 'items': segment_items})
+        time += rng.uniform(0.2, 2.0)
+        speaker = (speaker + rng.randint(1, speakers - 1)) % speakers if speakers > 1 else 0
+    return {
+        'results': {
+            'transcripts': [{'transcript': ''}],
+            'speaker_labels': {'speakers': speakers, 'segments': segments},
+            'items': items,
+        },
+        'status': 'COMPLETED',
+    }
+
+
+def _unit(vector: np.ndarray) -> np.ndarray:
+    return vector / np.linalg.norm(vector, axis=-1, keepdims=True)
+
+
+def embedding_stream(seconds: float, people: int = 6, analyzed_fps: float = 1.0, max_faces: int = 3,
+                     noise: float = 0.35, seed: int = 0) -> list[list[Person]]:
+    """
+    People detected on the analyzed frames: noisy embeddings around one center per person
+    :param seconds: media duration
+    :param people: number of distinct people
+    :param analyzed_fps: analyzed frames per second of media
+    :param max_faces: maximal number of faces on a frame
+    :param noise: spread of the embeddings of a person
+    :param seed:
+    :return: detected people per analyzed frame
+    """
+    rng = np.random.default_rng(seed)
+    centers = _unit(rng.normal(size=(people, EMBEDDING_SIZE)))
+    image = np.zeros((16, 16, 3), dtype=np.uint8)
+    frames = []
+    for _ in range(int(seconds * analyzed_fps)):
+        shown = rng.choice(people, size=rng.integers(0, max_faces + 1), replace=False)
+        embeddings = _unit(centers[shown] + noise * rng.normal(size=(len(shown), EMBEDDING_SIZE)) / np.sqrt(
+            EMBEDDING_SIZE))
+        persons = []
+        for embedding in embeddings:
+            x, y = rng.uniform(0, 1000, size=2)
+            side = rng.uniform(40, 300)
+            face = Face(bbox=np.array([x, y, x + side, y + side], dtype=np.float32), kps=np.zeros((5, 2)),
+                        det_score=float(rng.uniform(0.5, 1)), embedding=embedding.astype(np.float32))
+            persons.append(Person(img=image, diag=float(side * np.sqrt(2)), face=face))
+        frames.append(persons)
+    return frames
+
+
+def people(count: int, seconds: float, fps: float = 30, seed: int = 0) -> dict[str, Person]:
+    """
+    Persons with their frame counters and the frames they were shown on, as after processing a video
+    :param count: number of persons
+    :param seconds: media duration
+    :param fps:
+    :param seed:
+    :return: persons by name
+    """
+    rng = np.random.default_rng(seed)
+    image = np.zeros((16, 16, 3), dtype=np.uint8)
+    total_frames = int(seconds * fps)
+    result = {}
+    for index in range(count):
+        embedding = _unit(rng.normal(size=EMBEDDING_SIZE)).astype(np.float32)
+        face = Face(bbox=np.zeros(4, dtype=np.float32), kps=np.zeros((5, 2)), det_score=1.0, embedding=embedding)
+        person = Person(img=image, diag=float(rng.uniform(50, 400)), face=face)
+        person.name = f'person #{index}'
+        person.fps = fps
+        # shown in runs of a few seconds, as long as the person stays in the shot
+        frames = []
+        frame = int(rng.integers(1, fps * 10))
+        while frame < total_frames:
+            run = int(rng.integers(fps, fps * 20))
+            frames.extend(range(frame, min(frame + run, total_frames), int(rng.integers(1, 3))))
+            frame += run + int(rng.integers(fps, fps * 60))
+        person.showed_frames = frames or [1]
+        person.counter = len(person.showed_frames)
+        result[person.name] = person
+    return result
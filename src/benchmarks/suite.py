@@ -0,0 +1,202 @@
+"""
+Micro-benchmarks of the CPU hot paths of the pipeline on synthetic inputs.
+
+Every case runs on the sizes from benchmarks.fixtures.SIZES and records the best time of a few
+repeats and the peak traced memory of one more run. The results are compared with the stored
+baselines and the command fails if a case got slower or hungrier than the tolerance allows,
+or if a case has no baseline:
+
+    python -m benchmarks.suite run --sizes=small,medium,large --update-baselines   # store new baselines
+    python -m benchmarks.suite run --sizes=small,medium
+
+Baselines depend on the machine, so none are committed; create them on the machine the guardrail runs on.
+"""
+import copy
+import json
+import os
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, NamedTuple, Sequence, Union
+
+from fire import Fire
+
+from benchmarks import fixtures
+from dto import AWSItem
+from faces.faces import match_people
+from faces.utils import sort_people
+from subtitles.subtitles import create_subtitle, create_subtitles_file, format_time_for_subtitles, \
+    group_items_by_speaker
+from utils import create_markdown
+
+BASELINES_PATH = Path(__file__).parent / 'baselines.json'
+
+
+class Case(NamedTuple):
+    name: str
+    # builds the arguments of run for a size, not timed
+    setup: Callable[[fixtures.Size], tuple]
+    run: Callable
+
+
+_transcripts = {}
+
+
+def _transcript(size: fixtures.Size) -> dict:
+    if size.name not in _transcripts:
+        _transcripts[size.name] = fixtures.transcript(size.seconds)
+    return _transcripts[size.name]
+
+
+def _aws_items(size: fixtures.Size) -> list[AWSItem]:
+    response = _transcript(size)
+    speakers = {item['start_time']: segment['speaker_label']
+                for segment in response['results']['speaker_labels']['segments'] for item in segment['items']}
+    return [AWSItem(**item, speaker_label=speakers.get(item.get('start_time')))
+            for item in response['results']['items']]
+
+
+def _format_times(times: list[float]):
+    for time_value in times:
+        format_time_for_subtitles(time_value)
+
+
+def _match_stream(frames: list, threshold: float = 0.6):
+    persons = {}
+    for frame_number, new_persons in enumerate(frames, start=1):
+        match_people(persons, new_persons, frame_number, threshold)
+    return persons
+
+
+def _showed_times(persons: dict):
+    for person in persons.values():
+        person.showed_times()
+
+
+def _write_subtitles(items: list):
+    # formatting cost only, the disk does not matter here
+    create_subtitles_file(os.devnull, items)
+
+
+CASES = {case.name: case for case in [
+    Case('create_subtitle', lambda size: (_transcript(size),), create_subtitle),
+    Case('group_items_by_speaker', lambda size: (_aws_items(size),), group_items_by_speaker),
+    Case('format_time_for_subtitles',
+         lambda size: ([item.start_time for item in _aws_items(size) if item.start_time is not None],),
+         _format_times),
+    Case('create_subtitles_file', lambda size: (create_subtitle(_transcript(size)),), _write_subtitles),
+    Case('create_markdown', lambda size: (create_subtitle(_transcript(size)),), create_markdown),
+    # copies, match_people updates the persons of the stream in place
+    Case('match_people', lambda size: (copy.deepcopy(fixtures.embedding_stream(size.seconds)),), _match_stream),
+    Case('sort_people', lambda size: (fixtures.people(200, size.seconds),), sort_people),
+    Case('showed_times', lambda size: (fixtures.people(20, size.seconds),), _showed_times),
+]}
+
+
+def measure(case: Case, size: fixtures.Size, repeats: int = 3) -> dict:
+    """
+    Best time of the repeats and peak memory of one traced run, the setup is excluded from both
+    :param case:
+    :param size:
+    :param repeats:
+    :return:
+    """
+    timings = []
+    for _ in range(repeats):
+        args = case.setup(size)
+        start = time.perf_counter()
+        case.run(*args)
+        timings.append(time.perf_counter() - start)
+    args = case.setup(size)
+    tracemalloc.start()
+    try:
+        case.run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(timings), 'peak_bytes': peak}
+
+
+def load_baselines(baselines_path: Union[str, Path] = BASELINES_PATH) -> dict:
+    if not Path(baselines_path).exists():
+        return {}
+    with open(baselines_path, 'r') as f:
+        return json.load(f)
+
+
+def regressions(results: dict, baselines: dict, tolerance: float = 0.5, memory_tolerance: float = 0.2) -> list[str]:
+    """
+    Cases slower or using more memory than their baselines allow, or without a baseline
+    :param results: {case: {size: {'seconds':, 'peak_bytes':}}}
+    :param baselines: same structure
+    :param tolerance: allowed relative slowdown
+    :param memory_tolerance: allowed relative growth of the peak memory
+    :return: description of every regression
+    """
+    found = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            baseline = baselines.get(name, {}).get(size)
+            if baseline is None:
+                found.append(f'{name}[{size}]: no baseline, store one with --update-baselines')
+                continue
+            if result['seconds'] > baseline['seconds'] * (1 + tolerance):
+                found.append(f'{name}[{size}]: {result["seconds"]:.4f}s, baseline {baseline["seconds"]:.4f}s')
+            if result['peak_bytes'] > baseline['peak_bytes'] * (1 + memory_tolerance):
+                found.append(f'{name}[{size}]: peak {result["peak_bytes"] / 2 ** 20:.1f} MiB, '
+                             f'baseline {baseline["peak_bytes"] / 2 ** 20:.1f} MiB')
+    return found
+
+
+def _names(values: Union[str, Sequence[str]]) -> list[str]:
+    if isinstance(values, str):
+        values = values.split(',')
+    return [value.strip() for value in values if value.strip()]
+
+
+def run(sizes: Union[str, Sequence[str]] = ('small', 'medium'), cases: Union[str, Sequence[str]] = tuple(CASES),
+        repeats: int = 3, tolerance: float = 0.5, memory_tolerance: float = 0.2, update_baselines: bool = False,
+        baselines_path: str = str(BASELINES_PATH)):
+    """
+    Run the benchmarks and compare them with the baselines
+    :param sizes: sizes from benchmarks.fixtures.SIZES, comma separated on the command line
+    :param cases: case names from CASES, all by default
+    :param repeats: timed runs per case and size, the best one counts
+    :param tolerance: allowed relative slowdown before failing
+    :param memory_tolerance: allowed relative growth of the peak memory before failing
+    :param update_baselines: store the results as the new baselines instead of comparing
+    :param baselines_path:
+    :return:
+    """
+    baselines = load_baselines(baselines_path)
+    results = {}
+    print(f'{"case":<28}{"size":<8}{"seconds":>10}{"baseline":>10}{"peak MiB":>10}{"baseline":>10}')
+    for name in _names(cases):
+        for size_name in _names(sizes):
+            result = measure(CASES[name], fixtures.SIZES[size_name], repeats)
+            results.setdefault(name, {})[size_name] = result
+            baseline = baselines.get(name, {}).get(size_name)
+            baseline_seconds = f'{baseline["seconds"]:.4f}' if baseline else '-'
+            baseline_peak = f'{baseline["peak_bytes"] / 2 ** 20:.1f}' if baseline else '-'
+            print(f'{name:<28}{size_name:<8}{result["seconds"]:>10.4f}{baseline_seconds:>10}'
+                  f'{result["peak_bytes"] / 2 ** 20:>10.1f}{baseline_peak:>10}')
+
+    if update_baselines:
+        for name, sizes_results in results.items():
+            baselines.setdefault(name, {}).update(sizes_results)
+        with open(baselines_path, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Baselines saved to {baselines_path}')
+        return
+    found = regressions(results, baselines, tolerance, memory_tolerance)
+    if found:
+        print('Regressions:')
+        for regression in found:
+            print(f'    {regression}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    Fire({
+        'run': run,
+    })
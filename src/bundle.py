@@ -0,0 +1,314 @@
+"""
+Single file, memory-mappable bundle of everything known about a processed video.
+
+Layout, little endian:
+
+    magic b'TTABNDL\\0' | uint32 version | uint32 header size | json header | padding | sections
+
+The json header holds the metadata and, for every section, its dtype, shape and offset from the start
+of the data area. Sections are aligned to 64 bytes, so a reader maps the file and gets numpy views
+of only the sections it touches; nothing is parsed or unpickled up front.
+Text columns are stored as the utf-8 bytes of all the values and int64 offsets into them.
+Tables are groups of columns with a common prefix:
+
+    segments/start_time, segments/end_time, segments/speaker_label, segments/content
+    translations/<language>/...   same columns, one table per target language
+    speakers/...                  speaker turns of the transcript
+    faces/person, faces/start_time, faces/end_time
+    people/name, people/embedding
+
+    python bundle.py info video.tta
+    python bundle.py segments video.tta --table=translations/en-US
+"""
+import json
+import math
+import mmap
+import struct
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterable, Optional, Sequence, Union
+
+import numpy as np
+from fire import Fire
+
+from dto import Item
+
+MAGIC = b'TTABNDL\0'
+VERSION = 1
+ALIGNMENT = 64
+SUFFIX = '.tta'
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def bundle_path(video_path: Union[str, Path]) -> Path:
+    return Path(video_path).with_suffix(SUFFIX)
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class TextColumn(Sequence[str]):
+    """
+    Strings of a text section, decoded on access
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+
+class Bundle:
+    """
+    Read only view of a bundle file, the sections are mapped on demand
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, header_size = _PREAMBLE.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ValueError(f'{self.path} is not a bundle')
+            if version > VERSION:
+                raise ValueError(f'{self.path} has bundle version {version}, this code reads up to {VERSION}')
+            self.version = version
+            self.header = json.loads(self._map[_PREAMBLE.size:_PREAMBLE.size + header_size])
+        except BaseException:
+            self._file.close()
+            raise
+        self._data_start = _aligned(_PREAMBLE.size + header_size)
+        self.metadata: dict = self.header['metadata']
+
+    @property
+    def sections(self) -> list[str]:
+        return list(self.header['sections'])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.header['sections']
+
+    def tables(self, prefix: str = '') -> list[str]:
+        """
+        Names of the tables under prefix, e.g. the translated languages for 'translations/'
+        """
+        return sorted({name.rsplit('/', 1)[0] for name in self.sections if name.startswith(prefix) and '/' in name})
+
+    def _view(self, layout: dict) -> np.ndarray:
+        count = int(np.prod(layout['shape']))
+        if count == 0:
+            return np.empty(layout['shape'], dtype=np.dtype(layout['dtype']))
+        array = np.frombuffer(self._map, dtype=np.dtype(layout['dtype']), count=count,
+                              offset=self._data_start + layout['offset'])
+        return array.reshape(layout['shape'])
+
+    def array(self, name: str) -> np.ndarray:
+        """
+        Read only, zero copy view of an array section
+        """
+        layout = self.header['sections'][name]
+        if layout['kind'] != 'array':
+            raise TypeError(f'{name} is a {layout["kind"]} section')
+        return self._view(layout)
+
+    def text(self, name: str) -> TextColumn:
+        layout = self.header['sections'][name]
+        if layout['kind'] != 'text':
+            raise TypeError(f'{name} is a {layout["kind"]} section')
+        return TextColumn(self._view(layout['data']), self._view(layout['offsets']))
+
+    def column(self, name: str):
+        if self.header['sections'][name]['kind'] == 'text':
+            return self.text(name)
+        return self.array(name)
+
+    def table(self, prefix: str) -> dict:
+        """
+        Columns of the table by column name
+        """
+        return {name[len(prefix) + 1:]: self.column(name) for name in self.sections if name.startswith(f'{prefix}/')}
+
+    def items(self, prefix: str = 'segments') -> list[Item]:
+        """
+        Items of a segments table, e.g. 'segments' or 'translations/en-US'
+        """
+        start_times = self.array(f'{prefix}/start_time').tolist()
+        end_times = self.array(f'{prefix}/end_time').tolist()
+        speakers = self.text(f'{prefix}/speaker_label')
+        contents = self.text(f'{prefix}/content')
+        items = []
+        for index, (start_time, end_time) in enumerate(zip(start_times, end_times)):
+            item = Item(speakers[index] or None)
+            item.start_time = None if math.isnan(start_time) else start_time
+            item.end_time = None if math.isnan(end_time) else end_time
+            item._content = contents[index]
+            items.append(item)
+        return items
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # numpy views of the sections are still alive, the map is released with them
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BundleWriter:
+
+    def __init__(self, metadata: dict = None):
+        self.metadata = dict(metadata or {})
+        self._sections: dict[str, tuple] = {}
+
+    @classmethod
+    def from_bundle(cls, path: Union[str, Path]) -> 'BundleWriter':
+        """
+        Writer holding a copy of all the sections of an existing bundle, to add or replace some
+        """
+        with Bundle(path) as bundle:
+            writer = cls(bundle.metadata)
+            for name in bundle.sections:
+                column = bundle.column(name)
+                if isinstance(column, TextColumn):
+                    writer._sections[name] = ('text', column.data.copy(), column.offsets.copy())
+                else:
+                    writer._sections[name] = ('array', column.copy())
+        return writer
+
+    def add_array(self, name: str, array: np.ndarray):
+        self._sections[name] = ('array', np.ascontiguousarray(array))
+
+    def add_text(self, name: str, values: Iterable[str]):
+        encoded = [(value or '').encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        self._sections[name] = ('text', np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def add_items(self, prefix: str, items: list[Item]):
+        """
+        Segments table from items; missing times are stored as NaN
+        """
+        nan = float('nan')
+        self.add_array(f'{prefix}/start_time', np.array(
+            [nan if item.start_time is None else item.start_time for item in items], dtype='<f8'))
+        self.add_array(f'{prefix}/end_time', np.array(
+            [nan if item.end_time is None else item.end_time for item in items], dtype='<f8'))
+        self.add_text(f'{prefix}/speaker_label', [item.speaker_label for item in items])
+        self.add_text(f'{prefix}/content', [item.content() for item in items])
+
+    def add_speaker_turns(self, transcript: dict, prefix: str = 'speakers'):
+        """
+        Speaker turns of a Transcribe response
+        """
+        segments = transcript['results'].get('speaker_labels', {}).get('segments', [])
+        self.add_array(f'{prefix}/start_time', np.array([float(s['start_time']) for s in segments], dtype='<f8'))
+        self.add_array(f'{prefix}/end_time', np.array([float(s['end_time']) for s in segments], dtype='<f8'))
+        self.add_text(f'{prefix}/speaker_label', [segment['speaker_label'] for segment in segments])
+
+    def add_people(self, names: list[str], embeddings: np.ndarray, timelines: list[dict]):
+        """
+        People found in the video and when they are shown
+        :param names:
+        :param embeddings: mean face embedding of every person, in the order of names
+        :param timelines: rows with name, start_time and end_time, as from Person.showed_times
+        """
+        index = {name: position for position, name in enumerate(names)}
+        embeddings = np.asarray(embeddings, dtype='<f4')
+        self.add_text('people/name', names)
+        self.add_array('people/embedding', embeddings.reshape(len(names), -1) if names else embeddings.reshape(0, 0))
+        self.add_array('faces/person', np.array([index[row['name']] for row in timelines], dtype='<i4'))
+        self.add_array('faces/start_time', np.array([row['start_time'] for row in timelines], dtype='<f8'))
+        self.add_array('faces/end_time', np.array([row['end_time'] for row in timelines], dtype='<f8'))
+
+    def write(self, fileobj: BinaryIO):
+        """
+        Write the bundle to a binary file object, e.g. through store.atomic_write
+        """
+        sections = {}
+        blocks = []
+        offset = 0
+
+        def place(array: np.ndarray) -> dict:
+            nonlocal offset
+            offset = _aligned(offset)
+            layout = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            blocks.append((offset, array))
+            offset += array.nbytes
+            return layout
+
+        for name, section in self._sections.items():
+            if section[0] == 'array':
+                sections[name] = {'kind': 'array', **place(section[1])}
+            else:
+                sections[name] = {'kind': 'text', 'data': place(section[1]), 'offsets': place(section[2])}
+        header = json.dumps({'metadata': self.metadata, 'sections': sections}, ensure_ascii=False).encode('utf-8')
+        fileobj.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        fileobj.write(header)
+        position = _PREAMBLE.size + len(header)
+        data_start = _aligned(position)
+        for block_offset, array in blocks:
+            fileobj.write(b'\0' * (data_start + block_offset - position))
+            fileobj.write(array.tobytes())
+            position = data_start + block_offset + array.nbytes
+
+
+def open_bundle(path: Union[str, Path]) -> Optional[Bundle]:
+    """
+    The bundle at path, or next to the video at path; None if there is none
+    """
+    path = Path(path)
+    if path.suffix != SUFFIX:
+        path = bundle_path(path)
+    if not path.exists():
+        return None
+    return Bundle(path)
+
+
+def info(path: str):
+    """
+    Print the metadata and the sections of a bundle
+    """
+    start = time.perf_counter()
+    with open_bundle(path) as bundle:
+        elapsed = time.perf_counter() - start
+        print(f'{bundle.path} version {bundle.version}, opened in {elapsed * 1000:.2f} ms')
+        print(json.dumps(bundle.metadata, indent=2, ensure_ascii=False))
+        for name, layout in bundle.header['sections'].items():
+            if layout['kind'] == 'text':
+                print(f'    {name:<40} text[{layout["offsets"]["shape"][0] - 1}]')
+            else:
+                print(f'    {name:<40} {layout["dtype"]}{layout["shape"]}')
+
+
+def segments(path: str, table: str = 'segments'):
+    """
+    Print a segments table, e.g. --table=translations/en-US
+    """
+    with open_bundle(path) as bundle:
+        for item in bundle.items(table):
+            print(f'{item.speaker_label}: {item}')
+
+
+if __name__ == '__main__':
+    Fire({
+        'info': info,
+        'segments': segments,
+    })
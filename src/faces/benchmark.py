@@ -0,0 +1,131 @@
+"""
+Benchmark the inference profiles from faces.models on frames of a real video.
+
+For every profile it reports frames per second and how well the faces and embeddings agree
+with the baseline profile:
+
+    python -m faces.benchmark video.mp4 --profiles=default,cpu,cpu-int8 --frames=200
+"""
+import json
+import time
+from typing import Sequence, Union
+
+import cv2
+import numpy as np
+from fire import Fire
+
+from faces.faces import cosine_similarity
+from faces.models import PROFILES, create_face_analysis, resolve_profile
+
+
+def sample_frames(file_path: str, frames: int = 200) -> list[np.ndarray]:
+    """
+    Read `frames` frames evenly spread over the video
+    :param file_path:
+    :param frames:
+    :return: the frames, empty if the video cannot be read
+    """
+    cap = cv2.VideoCapture(file_path)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    step = max(total // frames, 1)
+    result = []
+    for frame_number in range(0, total, step):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+        ret, frame = cap.read()
+        if not ret:
+            break
+        result.append(frame)
+        if len(result) >= frames:
+            break
+    cap.release()
+    return result
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    x1, y1 = np.maximum(a[:2], b[:2])
+    x2, y2 = np.minimum(a[2:], b[2:])
+    intersection = max(x2 - x1, 0) * max(y2 - y1, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return float(intersection / union) if union > 0 else 0.0
+
+
+def run_profile(app, frames: list[np.ndarray]):
+    """
+    Run the detection and recognition on all frames
+    :param app:
+    :param frames:
+    :return: detected faces per frame and frames per second
+    """
+    if not frames:
+        raise ValueError('No frames to run the profile on')
+    app.get(frames[0])
+    start = time.perf_counter()
+    detections = [app.get(frame) for frame in frames]
+    elapsed = time.perf_counter() - start
+    return detections, len(frames) / elapsed
+
+
+def agreement(baseline: list, candidate: list, min_iou: float = 0.5) -> dict:
+    """
+    Match the candidate faces to the baseline faces by bounding box and compare the embeddings
+    :param baseline:
+    :param candidate:
+    :param min_iou:
+    :return:
+    """
+    similarities = []
+    baseline_faces = 0
+    for baseline_faces_in_frame, candidate_faces_in_frame in zip(baseline, candidate):
+        baseline_faces += len(baseline_faces_in_frame)
+        for face in baseline_faces_in_frame:
+            overlaps = [iou(face.bbox, other.bbox) for other in candidate_faces_in_frame]
+            if not overlaps or max(overlaps) < min_iou:
+                continue
+            other = candidate_faces_in_frame[int(np.argmax(overlaps))]
+            similarities.append(cosine_similarity(face.embedding, other.embedding))
+    return {
+        'baseline_faces': baseline_faces,
+        'matched_faces': len(similarities),
+        'recall': len(similarities) / baseline_faces if baseline_faces else 1.0,
+        'mean_similarity': float(np.mean(similarities)) if similarities else None,
+        'min_similarity': float(np.min(similarities)) if similarities else None,
+    }
+
+
+def benchmark(file_path: str, profiles: Union[str, Sequence[str]] = tuple(PROFILES), baseline: str = 'default',
+              frames: int = 200, output_path: str = None):
+    """
+    Benchmark inference profiles against the baseline profile
+    :param file_path: video to take the frames from
+    :param profiles: profile names, comma separated on the command line
+    :param baseline: profile the embeddings are compared with
+    :param frames: number of frames to run on
+    :param output_path: optional json file for the report
+    :return:
+    """
+    if isinstance(profiles, str):
+        profiles = [profile.strip() for profile in profiles.split(',')]
+    video_frames = sample_frames(file_path, frames)
+    if not video_frames:
+        raise ValueError(f'Cannot read any frame of {file_path}, is it a video?')
+    baseline_detections, baseline_fps = run_profile(create_face_analysis(baseline), video_frames)
+    report = {baseline: {'fps': baseline_fps, **agreement(baseline_detections, baseline_detections)}}
+    for name in profiles:
+        if name == baseline:
+            continue
+        detections, fps = run_profile(create_face_analysis(resolve_profile(name)), video_frames)
+        report[name] = {'fps': fps, **agreement(baseline_detections, detections)}
+
+    print(f'{"profile":<16}{"fps":>8}{"recall":>8}{"mean sim":>10}{"min sim":>10}')
+    for name, row in report.items():
+        mean_similarity = '-' if row['mean_similarity'] is None else f'{row["mean_similarity"]:.4f}'
+        min_similarity = '-' if row['min_similarity'] is None else f'{row["min_similarity"]:.4f}'
+        print(f'{name:<16}{row["fps"]:>8.2f}{row["recall"]:>8.3f}{mean_similarity:>10}{min_similarity:>10}')
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    Fire(benchmark)
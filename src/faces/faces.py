@@ -1,17 +1,15 @@
-from typing import List, Dict
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
 
 import cv2
 import numpy as np
-from insightface.app import FaceAnalysis
 from tqdm import tqdm
 
+from faces.models import pool
+from faces.scene import SceneChangeDetector
+from faces.schedule import FrameSchedule, speech_intervals
 from faces.utils import Person, Face, save_people_faces, sort_people
-
-app = FaceAnalysis(
-    allowed_modules=['recognition', 'detection'],
-    providers=['CUDAExecutionProvider', 'CPUExecutionProvider']
-)
-app.prepare(ctx_id=0, det_size=(640, 640))
+from instrumentation import count, gauge, span, traced
 
 
 def cosine_similarity(x, y) -> float:
@@ -46,67 +44,174 @@ def create_people(img: np.array, faces: List[Face]) -> List[Person]:
     return fd_sorted
 
 
-def process_media(image: np.array) -> List[Person]:
+def process_media(image: np.array, app=None) -> List[Person]:
     """
     Process media and return list of Person objects
     :param image:
+    :param app: prepared FaceAnalysis, the default one from the model pool if not set
     :return:
     """
+    if app is None:
+        app = pool.get()
     faces = [Face(**face) for face in app.get(image)]
     people = create_people(image, faces)
     return people
 
 
-def generate_frames(file_path) -> np.array:
+def video_fps(file_path, default: float = 30) -> float:
+    cap = cv2.VideoCapture(file_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return fps or default
+
+
+def generate_frames(file_path, should_analyze: Callable[[int], bool] = None,
+                    on_end: Callable[[int], None] = None) -> Iterator[Tuple[int, np.array]]:
     """
     Generator for frames from video
     :param file_path:
-    :return:
+    :param should_analyze: frames it rejects are skipped without decoding
+    :param on_end: called with the number of frames in the video, skipped ones included, once it is read
+    :return: 1-based frame number and the frame
     """
     # read video by opencv
     cap = cv2.VideoCapture(file_path)
 
     pbar = tqdm(total=int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    frame_number = 0
     while cap.isOpened():
         pbar.update(1)
+        frame_number += 1
+        if should_analyze is not None and not should_analyze(frame_number):
+            if not cap.grab():
+                break
+            continue
         ret, frame = cap.read()
         if not ret:
             break
-        yield frame
+        yield frame_number, frame
     cap.release()
+    if on_end is not None:
+        # the last frame number is the failed read past the end
+        on_end(max(frame_number - 1, 0))
 
 
-def process(file_path, threshold=0.6):
+def match_people(persons: Dict[str, Person], new_persons: List[Person], frame_number: int, threshold: float,
+                 fps: float = 30) -> List[str]:
+    """
+    Assign the people found on a frame to the known persons or register them as new persons
+    :param persons: known persons by name, updated in place
+    :param new_persons:
+    :param frame_number:
+    :param threshold: minimal cosine similarity to the mean face of a known person
+    :param fps:
+    :return: names of the persons shown on the frame
+    """
+    names = []
+    for person in new_persons:
+        for name, current_person in persons.items():
+            similarity = cosine_similarity(current_person.mean_face(), person.face.embedding)
+            if similarity >= threshold:
+                current_person.faces.append(person.face)
+                current_person.showed_frames.append(frame_number)
+                current_person.counter += 1
+                if person.diag > current_person.diag:
+                    current_person.img = person.img
+                    current_person.diag = person.diag
+                names.append(name)
+                break
+        else:
+            person.name = f'person #{len(persons)}'
+            person.fps = fps
+            person.showed_frames.append(frame_number)
+            persons[person.name] = person
+            names.append(person.name)
+    return names
+
+
+def reuse_people(persons: Dict[str, Person], names: List[str], frame_number: int):
+    """
+    Mark the persons matched on the last analyzed frame as shown on this frame
+    :param persons:
+    :param names:
+    :param frame_number:
+    :return:
+    """
+    for name in names:
+        persons[name].showed_frames.append(frame_number)
+        persons[name].counter += 1
+
+
+def timeline_gap(transcript=None, sparse_every: int = 30, **_) -> int:
+    """
+    max_gap for Person.showed_times of the people from process: with a transcript the frames outside
+    of speech are analyzed only every sparse_every frames, a person on screen is still one interval
+    :param transcript: as given to process
+    :param sparse_every: as given to process
+    :return:
+    """
+    return max(int(sparse_every), 2) if transcript is not None else 2
+
+
+@traced('process_faces')
+def process(file_path, threshold=0.6, profile=None, providers=None, threads=None, transcript=None,
+            speech_margin=1.0, sparse_every=30, scene_threshold=None, max_reuse=30, show=True):
     """"
     Process video and return list of Person objects
     :param threshold:
     :param file_path:
+    :param profile: inference profile name from faces.models.PROFILES, e.g. 'cpu-int8'
+    :param providers: onnxruntime execution providers, e.g. 'CPUExecutionProvider'
+    :param threads: number of onnxruntime threads, the profile default if not set
+    :param transcript: Transcribe response (or its json path) or items from create_subtitle;
+        if set, frames are fully analyzed only while somebody speaks
+    :param speech_margin: seconds around the speech intervals that are still fully analyzed
+    :param sparse_every: analyze every n-th frame outside of the speech intervals
+    :param scene_threshold: if set, frames that differ less than this from the last analyzed frame
+        reuse its detections (see faces.scene.SceneChangeDetector)
+    :param max_reuse: analyze at least every n-th frame when the scene does not change
+    :param show: show the frames with the top people while processing
+    :return: people by name; pass timeline_gap(...) of the same arguments to their showed_times
     """
+    with span('faces.load_models'):
+        app = pool.get(profile, providers, threads)
+    fps = video_fps(file_path)
+    schedule = None
+    if transcript is not None:
+        schedule = FrameSchedule(speech_intervals(transcript, speech_margin), fps, sparse_every)
+    detector = None
+    if scene_threshold is not None:
+        detector = SceneChangeDetector(scene_threshold, max_reuse)
     # read video by opencv
     frame_number = 0
+    frame_count = 0
     persons: Dict[str, Person] = {}
-
-    for frame in generate_frames(file_path):
-        frame_number += 1
-        new_persons = process_media(frame)
+    names: List[str] = []
+    started = time.perf_counter()
+
+    def set_frame_count(total: int):
+        nonlocal frame_count
+        frame_count = total
+
+    frames = generate_frames(file_path, schedule.should_analyze if schedule else None, set_frame_count)
+    for frame_number, frame in frames:
+        count('faces.frames')
+        if detector is not None and not detector.changed(frame):
+            reuse_people(persons, names, frame_number)
+        else:
+            start = time.perf_counter()
+            with span('faces.inference'):
+                new_persons = process_media(frame, app)
+            with span('faces.match_people'):
+                names = match_people(persons, new_persons, frame_number, threshold, fps)
+            count('faces.inferences')
+            if detector is not None:
+                detector.record_inference(time.perf_counter() - start)
+
+        if not show:
+            continue
         size = 144
         right_faces_panel = np.zeros((frame.shape[0], size, 3), dtype=np.uint8)
-        for i, person in enumerate(new_persons):
-            for name, current_person in persons.items():
-                similarity = cosine_similarity(current_person.mean_face(), person.face.embedding)
-                if similarity >= threshold:
-                    current_person.faces.append(person.face)
-                    current_person.showed_frames.append(frame_number)
-                    current_person.counter += 1
-                    if person.diag > current_person.diag:
-                        current_person.img = person.img
-                        current_person.diag = person.diag
-                    break
-            else:
-                person.name = f'person #{len(persons)}'
-                person.showed_frames.append(frame_number)
-                persons[person.name] = person
-
         sorted_persons = sort_people(persons)
 
         faces = [person.resized_img(size) for person in sorted_persons[:5]]
@@ -117,7 +222,15 @@ def process(file_path, threshold=0.6):
         cv2.imshow('frame', show_frame)
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
+    # stopped with 'q' before the end of the video
+    frame_count = frame_count or frame_number
+    gauge('faces.frames_per_second', frame_count / max(time.perf_counter() - started, 1e-9))
+    if schedule is not None:
+        print(schedule)
+    if detector is not None:
+        print(detector)
     save_people_faces('people', persons, top_k=5)
-    print('frame_number', frame_number)
+    print('frame_number', frame_count)
     with open('frame_number.txt', 'w') as f:
-        f.write(str(frame_number))
+        f.write(str(frame_count))
+    return persons
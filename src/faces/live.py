@@ -0,0 +1,219 @@
+"""
+Face analysis of a recording in progress: a growing file or a stream URL.
+
+A reader thread decodes the source and keeps only the newest frame; the analysis takes it when it
+is free, so frames are dropped while the inference is busy instead of piling up, and frames older
+than the latency budget are skipped. The timeline and the roster of people are written to the
+output folder every flush interval, so they can be read while the hearing goes on:
+
+    python -m faces.live recording.mkv --output_folder=live --latency_budget=1 --flush_interval=10
+
+A growing file has to be in a container that is readable while written (mkv, ts, fragmented mp4).
+"""
+import csv
+import io
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from fire import Fire
+
+from faces.faces import match_people, process_media, video_fps
+from faces.models import pool
+from faces.utils import Person, save_people_faces
+from instrumentation import count, gauge, span, traced
+from store import atomic_write
+
+
+class LatestFrame:
+    """
+    One frame slot between the reader and the analysis; a new frame replaces the one not taken yet
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._entry: Optional[Tuple[int, float, np.ndarray]] = None
+        self.closed = False
+        self.read = 0
+        self.replaced = 0
+
+    def put(self, frame_number: int, frame: np.ndarray):
+        with self._condition:
+            if self._entry is not None:
+                self.replaced += 1
+            self._entry = (frame_number, time.monotonic(), frame)
+            self.read += 1
+            self._condition.notify()
+
+    def get(self, timeout: float) -> Optional[Tuple[int, float, np.ndarray]]:
+        """
+        :return: frame number, monotonic time it was read and the frame; None on timeout or when closed
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._entry is not None or self.closed, timeout)
+            entry, self._entry = self._entry, None
+            return entry
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+def _is_stream(source: Union[str, int]) -> bool:
+    return isinstance(source, int) or '://' in str(source)
+
+
+def read_frames(source: Union[str, int], slot: LatestFrame, stop: threading.Event, poll_interval: float = 0.5,
+                idle_timeout: float = 30.0):
+    """
+    Decode the source into the slot until it stops growing for idle_timeout seconds or stop is set.
+    A file is reopened at the next frame once its end is reached; a stream is reconnected.
+    """
+    frame_number = 0
+    last_frame = time.monotonic()
+    try:
+        while not stop.is_set():
+            cap = cv2.VideoCapture(source)
+            if frame_number and not _is_stream(source):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            while not stop.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame_number += 1
+                last_frame = time.monotonic()
+                slot.put(frame_number, frame)
+            cap.release()
+            if time.monotonic() - last_frame > idle_timeout:
+                logging.info(f'No new frames from {source} for {idle_timeout}s, stopping')
+                break
+            stop.wait(poll_interval)
+    finally:
+        slot.close()
+
+
+class LiveStats:
+
+    def __init__(self):
+        self.analyzed = 0
+        self.late = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def record(self, lag: float):
+        self.analyzed += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def __str__(self):
+        mean_lag = self.total_lag / self.analyzed if self.analyzed else 0.0
+        return (f'LiveStats[analyzed:{self.analyzed} late:{self.late} '
+                f'mean lag:{mean_lag:.2f}s max lag:{self.max_lag:.2f}s]')
+
+
+def flush(output_folder: str, persons: Dict[str, Person], max_gap: int):
+    """
+    Write the timeline (timeline.csv) and the roster (roster.json) of the people seen so far
+    """
+    rows = []
+    roster = []
+    for person in persons.values():
+        times = person.showed_times(max_gap).to_dict('records')
+        rows.extend(times)
+        roster.append({
+            'name': person.name,
+            'first_seen': times[0]['start_time'],
+            'last_seen': times[-1]['end_time'],
+            'shown_seconds': sum(row['end_time'] - row['start_time'] for row in times),
+            'analyzed_frames': person.counter,
+        })
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=['name', 'start_time', 'end_time'])
+    writer.writeheader()
+    writer.writerows(sorted(rows, key=lambda row: row['start_time']))
+    timeline = buffer.getvalue().encode('utf-8')
+    atomic_write(Path(output_folder) / 'timeline.csv', lambda f: f.write(timeline))
+    roster_data = json.dumps(roster, indent=2).encode('utf-8')
+    atomic_write(Path(output_folder) / 'roster.json', lambda f: f.write(roster_data))
+    count('faces.live.flushes')
+
+
+@traced('process_faces_live')
+def follow(source: Union[str, int], output_folder: str = 'live', latency_budget: float = 1.0,
+           flush_interval: float = 10.0, threshold: float = 0.6, profile=None, providers=None, threads=None,
+           fps: float = None, gap_seconds: float = 2.0, max_faces: int = 200, poll_interval: float = 0.5,
+           idle_timeout: float = 30.0) -> Dict[str, Person]:
+    """
+    Analyze the faces of a growing recording or a stream until it ends (or Ctrl+C)
+    :param source: growing video file, stream URL or camera index
+    :param output_folder: timeline.csv and roster.json are written there, the people faces at the end
+    :param latency_budget: frames read longer than this many seconds ago are dropped
+    :param flush_interval: seconds between writes of the timeline and the roster
+    :param threshold: face matching threshold
+    :param profile: inference profile, see faces.models.PROFILES
+    :param providers:
+    :param threads:
+    :param fps: frames per second of the source, read from it if not set
+    :param gap_seconds: appearances at most this far apart are merged in the timeline
+    :param max_faces: faces kept per person for the mean embedding, the most recent ones
+    :param poll_interval: seconds between checks of a file that stopped growing
+    :param idle_timeout: stop when no frame came for this many seconds
+    :return: people by name
+    """
+    with span('faces.load_models'):
+        app = pool.get(profile, providers, threads)
+    fps = fps or video_fps(source)
+    max_gap = max(int(gap_seconds * fps), 2)
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    slot = LatestFrame()
+    stop = threading.Event()
+    reader = threading.Thread(target=read_frames, args=(source, slot, stop, poll_interval, idle_timeout),
+                              name='live-reader', daemon=True)
+    reader.start()
+    persons: Dict[str, Person] = {}
+    stats = LiveStats()
+    last_flush = time.monotonic()
+    try:
+        while True:
+            entry = slot.get(timeout=poll_interval)
+            if entry is None and slot.closed:
+                break
+            if entry is not None:
+                frame_number, read_at, frame = entry
+                if time.monotonic() - read_at > latency_budget:
+                    stats.late += 1
+                    continue
+                with span('faces.inference'):
+                    new_persons = process_media(frame, app)
+                with span('faces.match_people'):
+                    names = match_people(persons, new_persons, frame_number, threshold, fps)
+                for name in names:
+                    persons[name].faces = persons[name].faces[-max_faces:]
+                stats.record(time.monotonic() - read_at)
+                gauge('faces.live.lag_seconds', time.monotonic() - read_at)
+            if persons and time.monotonic() - last_flush >= flush_interval:
+                flush(output_folder, persons, max_gap)
+                last_flush = time.monotonic()
+                logging.info(f'{len(persons)} people, {stats}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        reader.join()
+    if persons:
+        flush(output_folder, persons, max_gap)
+        save_people_faces(Path(output_folder) / 'people', persons, top_k=len(persons))
+    count('faces.frames', slot.read)
+    count('faces.inferences', stats.analyzed)
+    print(f'read:{slot.read} replaced:{slot.replaced} {stats}')
+    return persons
+
+
+if __name__ == '__main__':
+    Fire(follow)
@@ -0,0 +1,212 @@
+"""
+Lazily loaded insightface models.
+
+Nothing heavy happens at import time: insightface (and onnxruntime behind it) is imported and the
+models are prepared only when a model is first requested from the pool.
+"""
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+DEFAULT_PROVIDERS = ('CUDAExecutionProvider', 'CPUExecutionProvider')
+DEFAULT_DET_SIZE = (640, 640)
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+
+class InferenceProfile(NamedTuple):
+    name: str
+    providers: Tuple[str, ...] = DEFAULT_PROVIDERS
+    intra_op_threads: Optional[int] = None
+    inter_op_threads: Optional[int] = None
+    graph_optimization: str = 'all'
+    quantized: bool = False
+    det_size: Tuple[int, int] = DEFAULT_DET_SIZE
+
+    def custom_session(self) -> bool:
+        """
+        True if the onnxruntime sessions created by insightface have to be replaced
+        """
+        return (self.intra_op_threads is not None or self.inter_op_threads is not None
+                or self.graph_optimization != 'all' or self.quantized)
+
+
+_CPU = ('CPUExecutionProvider',)
+_CORES = os.cpu_count() or 1
+
+PROFILES = {
+    'default': InferenceProfile('default'),
+    'cpu': InferenceProfile('cpu', providers=_CPU, intra_op_threads=_CORES, inter_op_threads=1),
+    'cpu-small': InferenceProfile('cpu-small', providers=_CPU, intra_op_threads=_CORES, inter_op_threads=1,
+                                  det_size=(320, 320)),
+    'cpu-int8': InferenceProfile('cpu-int8', providers=_CPU, intra_op_threads=_CORES, inter_op_threads=1,
+                                 quantized=True),
+    'cpu-int8-small': InferenceProfile('cpu-int8-small', providers=_CPU, intra_op_threads=_CORES,
+                                       inter_op_threads=1, quantized=True, det_size=(320, 320)),
+}
+
+
+def parse_providers(providers: Union[str, Sequence[str], None]) -> Tuple[str, ...]:
+    """
+    Normalize providers coming from python code or from the command line ('CPUExecutionProvider,...')
+    :param providers:
+    :return:
+    """
+    if providers is None:
+        return DEFAULT_PROVIDERS
+    if isinstance(providers, str):
+        providers = [provider.strip() for provider in providers.split(',') if provider.strip()]
+    return tuple(providers)
+
+
+def resolve_profile(profile: Union[str, InferenceProfile, None] = None,
+                    providers: Union[str, Sequence[str], None] = None,
+                    threads: Optional[int] = None,
+                    det_size: Optional[Tuple[int, int]] = None) -> InferenceProfile:
+    """
+    Take a named (or given) profile and override the fields set explicitly
+    :param profile: name from PROFILES or an InferenceProfile, 'default' if not set
+    :param providers:
+    :param threads: intra-op threads
+    :param det_size:
+    :return:
+    """
+    if profile is None:
+        profile = 'default'
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise ValueError(f'Unknown inference profile {profile}, expected one of {", ".join(PROFILES)}')
+        profile = PROFILES[profile]
+    if providers is not None:
+        profile = profile._replace(providers=parse_providers(providers))
+    if threads is not None:
+        profile = profile._replace(intra_op_threads=int(threads))
+    if det_size is not None:
+        profile = profile._replace(det_size=tuple(det_size))
+    return profile
+
+
+def _available_providers(providers: Sequence[str]) -> list[str]:
+    import onnxruntime
+
+    available = set(onnxruntime.get_available_providers())
+    selected = [provider for provider in providers if provider in available]
+    return selected or ['CPUExecutionProvider']
+
+
+def quantized_model_path(model_file: str) -> str:
+    """
+    Quantize the model weights to int8 once and keep the result next to the original model
+    :param model_file:
+    :return:
+    """
+    quantized_path = Path(model_file).with_suffix('.int8.onnx')
+    if not quantized_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        logging.info(f'Quantizing {model_file} to {quantized_path}')
+        quantize_dynamic(model_file, str(quantized_path), weight_type=QuantType.QInt8)
+    return str(quantized_path)
+
+
+def session_options(profile: InferenceProfile):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if profile.intra_op_threads is not None:
+        options.intra_op_num_threads = profile.intra_op_threads
+    if profile.inter_op_threads is not None:
+        options.inter_op_num_threads = profile.inter_op_threads
+        if profile.inter_op_threads > 1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    level = GRAPH_OPTIMIZATION_LEVELS[profile.graph_optimization]
+    options.graph_optimization_level = getattr(onnxruntime.GraphOptimizationLevel, level)
+    return options
+
+
+def _rebuild_sessions(app, providers: Sequence[str], profile: InferenceProfile):
+    """
+    insightface does not expose onnxruntime session options, so the sessions are recreated
+    from the same (or the quantized) model files with the profile settings.
+    """
+    import onnxruntime
+
+    options = session_options(profile)
+    for model in app.models.values():
+        model_file = quantized_model_path(model.model_file) if profile.quantized else model.model_file
+        model.session = onnxruntime.InferenceSession(model_file, sess_options=options, providers=providers)
+
+
+def create_face_analysis(profile: Union[str, InferenceProfile, None] = None, ctx_id: int = 0):
+    """
+    Create and prepare a FaceAnalysis application
+    :param profile: name from PROFILES or an InferenceProfile
+    :param ctx_id:
+    :return:
+    """
+    from insightface.app import FaceAnalysis
+
+    profile = resolve_profile(profile)
+    providers = _available_providers(profile.providers)
+    app = FaceAnalysis(allowed_modules=['recognition', 'detection'], providers=providers)
+    if profile.custom_session():
+        _rebuild_sessions(app, providers, profile)
+    app.prepare(ctx_id=ctx_id, det_size=profile.det_size)
+    return app
+
+
+class FaceModelPool:
+    """
+    Prepared FaceAnalysis applications keyed by their inference profile.
+
+    Long-running hosts (Streamlit, batch workers) keep the module level `pool` and pay
+    the model loading only once per profile.
+    """
+
+    def __init__(self):
+        self._apps = {}
+        self._lock = threading.Lock()
+
+    def get(self, profile: Union[str, InferenceProfile, None] = None,
+            providers: Union[str, Sequence[str], None] = None, threads: Optional[int] = None,
+            det_size: Optional[Tuple[int, int]] = None):
+        profile = resolve_profile(profile, providers, threads, det_size)
+        key = profile._replace(name='')
+        with self._lock:
+            app = self._apps.get(key)
+            if app is None:
+                logging.info(f'Loading face models {profile}')
+                app = create_face_analysis(profile)
+                self._apps[key] = app
+        return app
+
+    def warm_up(self, profile: Union[str, InferenceProfile, None] = None,
+                providers: Union[str, Sequence[str], None] = None, threads: Optional[int] = None,
+                det_size: Optional[Tuple[int, int]] = None):
+        """
+        Load the models and run one inference so the first real frame does not pay for it
+        """
+        profile = resolve_profile(profile, providers, threads, det_size)
+        app = self.get(profile)
+        width, height = profile.det_size
+        app.get(np.zeros((height, width, 3), dtype=np.uint8))
+        return app
+
+    def clear(self):
+        with self._lock:
+            self._apps.clear()
+
+    def __len__(self):
+        return len(self._apps)
+
+
+pool = FaceModelPool()
@@ -0,0 +1,67 @@
+"""
+Cheap scene change detection used to skip the face inference on static frames.
+"""
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+
+class SceneChangeDetector:
+    """
+    Compare frames on a small grayscale thumbnail.
+
+    The thumbnail is compared with the one of the last analyzed frame rather than with the previous
+    frame, so a slow drift (camera pan, lighting) still triggers a new inference once it adds up.
+    """
+
+    def __init__(self, threshold: float = 4.0, max_reuse: int = 30, thumbnail_size: Tuple[int, int] = (64, 36)):
+        """
+        :param threshold: mean absolute difference of the thumbnails (0-255) that counts as a change
+        :param max_reuse: force an inference after this many reused frames
+        :param thumbnail_size: width and height of the thumbnail
+        """
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.thumbnail_size = thumbnail_size
+        self._reference = None
+        self._reused = 0
+        self.skipped = 0
+        self.analyzed = 0
+        self.inference_seconds = 0.0
+
+    def thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, self.thumbnail_size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def changed(self, frame: np.ndarray) -> bool:
+        """
+        Check if the frame needs a new inference; the frame becomes the reference if it does
+        :param frame:
+        :return:
+        """
+        thumbnail = self.thumbnail(frame)
+        if (self._reference is not None and self._reused < self.max_reuse
+                and np.mean(np.abs(thumbnail - self._reference)) < self.threshold):
+            self._reused += 1
+            self.skipped += 1
+            return False
+        self._reference = thumbnail
+        self._reused = 0
+        return True
+
+    def record_inference(self, seconds: float):
+        self.analyzed += 1
+        self.inference_seconds += seconds
+
+    @property
+    def saved_seconds(self) -> float:
+        """
+        Estimated inference time saved by the skipped frames
+        """
+        if self.analyzed == 0:
+            return 0.0
+        return self.skipped * self.inference_seconds / self.analyzed
+
+    def __str__(self):
+        return f'SceneChangeDetector[analyzed:{self.analyzed} skipped:{self.skipped} saved:{self.saved_seconds:.1f}s]'
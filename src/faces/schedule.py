@@ -0,0 +1,80 @@
+"""
+Frame schedules for the face analysis.
+
+Full inference is only needed while somebody speaks, so the transcript timings are turned into
+speech intervals and the frames outside of them are sampled sparsely.
+"""
+import json
+from bisect import bisect_right
+from typing import Iterable, List, Tuple, Union
+
+from dto import Item
+
+Interval = Tuple[float, float]
+
+
+def _transcript_timings(transcript) -> Iterable[Interval]:
+    if isinstance(transcript, str):
+        with open(transcript, 'r') as f:
+            transcript = json.load(f)
+    if isinstance(transcript, dict):
+        for item in transcript['results']['items']:
+            if 'start_time' in item:
+                yield float(item['start_time']), float(item['end_time'])
+        return
+    for item in transcript:
+        if isinstance(item, Item) and item.start_time is not None:
+            yield item.start_time, item.end_time
+
+
+def speech_intervals(transcript: Union[str, dict, List[Item]], margin: float = 1.0) -> List[Interval]:
+    """
+    Merge the transcript timings into sorted, non-overlapping speech intervals
+    :param transcript: Transcribe response, path to its json file or items from create_subtitle
+    :param margin: seconds added before and after every timing
+    :return:
+    """
+    timings = sorted((max(start - margin, 0.0), end + margin) for start, end in _transcript_timings(transcript))
+    intervals: List[Interval] = []
+    for start, end in timings:
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1] = (intervals[-1][0], max(intervals[-1][1], end))
+        else:
+            intervals.append((start, end))
+    return intervals
+
+
+class FrameSchedule:
+    """
+    Decide which frames get full inference: all frames inside the speech intervals
+    and every `sparse_every` frame elsewhere.
+    """
+
+    def __init__(self, intervals: List[Interval], fps: float, sparse_every: int = 30):
+        self.fps = fps
+        self.sparse_every = max(int(sparse_every), 1)
+        self._starts = [start for start, _ in intervals]
+        self._ends = [end for _, end in intervals]
+        self.analyzed = 0
+        self.skipped = 0
+
+    def in_speech(self, time: float) -> bool:
+        index = bisect_right(self._starts, time) - 1
+        return index >= 0 and time <= self._ends[index]
+
+    def should_analyze(self, frame_number: int) -> bool:
+        """
+        :param frame_number: 1-based frame number
+        :return:
+        """
+        analyze = (frame_number - 1) % self.sparse_every == 0 or self.in_speech((frame_number - 1) / self.fps)
+        if analyze:
+            self.analyzed += 1
+        else:
+            self.skipped += 1
+        return analyze
+
+    def __str__(self):
+        total = self.analyzed + self.skipped
+        ratio = self.skipped / total if total else 0.0
+        return f'FrameSchedule[analyzed:{self.analyzed} skipped:{self.skipped} ({ratio:.0%})]'
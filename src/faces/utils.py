@@ -4,9 +4,6 @@ from typing import NamedTuple
 
 import cv2
 import numpy as np
-import pandas as pd
-
-from dto import Item
 
 
 class Face(NamedTuple):
@@ -50,12 +47,19 @@ class Person:
         self._showed_times = []
         self.fps = 30
 
-    def showed_times(self):
+    def showed_times(self, max_gap: int = 2):
+        """
+        Intervals the person is shown in
+        :param max_gap: frames shown at most this many frames apart belong to the same interval
+        :return: DataFrame with name, start_time and end_time
+        """
+        import pandas as pd
+
         seqs = []
         prev = self.showed_frames[0]
         last_seq = [prev]
         for x in self.showed_frames[1:]:
-            if abs(x - prev) <= 2:
+            if abs(x - prev) <= max_gap:
                 last_seq.append(x)
             else:
                 seqs.append(last_seq)
@@ -94,11 +98,6 @@ def save_people_faces(save_directory, persons: dict[str, Person], top_k=5):
     sorted_persons = sort_people(persons)
 
     Path(save_directory).mkdir(parents=True, exist_ok=True)
-    for name, person in sorted_persons[:top_k]:
-        person.save(Path(save_directory) / f'{name}.pickle')
+    for person in sorted_persons[:top_k]:
+        person.save(Path(save_directory) / f'{person.name}.pickle')
 
-
-def save_translated_items(save_directory, translated_items: list[Item]):
-    Path(save_directory).mkdir(parents=True, exist_ok=True)
-    for translated_item in translated_items:
-        translated_item.save(Path(save_directory) / f'translated_item-{id(translated_items)}.pickle')
@@ -0,0 +1,190 @@
+"""
+Optional HTTP server for the preview videos and the downloads of the app, with byte range support.
+
+Streamlit buffers the files given to st.video and st.download_button in its own process; with this server
+the files are streamed from disk instead and the browser seeks with range requests. The outputs to download
+are published as hard links in the downloads folder, next to them nothing else is reachable. It has no
+authentication, so
+it is off unless TTA_FILES_PORT is set, listens on 127.0.0.1 unless TTA_FILES_HOST says otherwise,
+and serves only the files under SERVED_FOLDERS. Put it behind the same proxy as Streamlit and set
+TTA_FILES_URL to its address as seen by the browser:
+
+    TTA_FILES_PORT=8502 TTA_FILES_URL=https://example.org/files streamlit run streamlit_app.py
+
+Without it (e.g. on Streamlit Community Cloud, where only the Streamlit port is reachable)
+the app gives the previews to Streamlit and loads a download only when it is asked for.
+"""
+import logging
+import mimetypes
+import os
+import re
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+DATA_FOLDER = 'data'
+# folders under DATA_FOLDER the server gives access to; uploads, results and jobs stay private
+DOWNLOADS_FOLDER = 'downloads'
+SERVED_FOLDERS = ('previews', DOWNLOADS_FOLDER)
+FILES_ENABLED = bool(os.environ.get('TTA_FILES_PORT'))
+FILES_HOST = os.environ.get('TTA_FILES_HOST', '127.0.0.1')
+FILES_PORT = int(os.environ.get('TTA_FILES_PORT') or 8502)
+# address of the server as seen by the browser
+FILES_URL = os.environ.get('TTA_FILES_URL', f'http://localhost:{FILES_PORT}')
+CHUNK_SIZE = 1024 * 1024
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    First and last byte of a single range Range header
+    :param header: e.g. 'bytes=0-1023', 'bytes=1024-' or 'bytes=-500'
+    :param size: file size
+    :return: None for the whole file
+    :raises ValueError: if the range cannot be satisfied
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if match is None:
+        # multiple ranges or other units, answer with the whole file
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        raise ValueError(header)
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    root = Path(DATA_FOLDER)
+    served_folders = SERVED_FOLDERS
+
+    def _resolve(self) -> Optional[Path]:
+        root = self.root.resolve()
+        path = (root / unquote(urlparse(self.path).path).lstrip('/')).resolve()
+        if not any((root / folder).resolve() in path.parents for folder in self.served_folders):
+            return None
+        if not path.is_file():
+            return None
+        return path
+
+    def _send_file(self, send_body: bool):
+        path = self._resolve()
+        if path is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        size = path.stat().st_size
+        try:
+            byte_range = parse_range(self.headers.get('Range'), size)
+        except ValueError:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+        self.send_header('Content-Type', mimetypes.guess_type(path.name)[0] or 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Cache-Control', 'private, max-age=3600')
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        download_name = parse_qs(urlparse(self.path).query).get('download')
+        if download_name:
+            self.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(download_name[0])}")
+        self.end_headers()
+        if not send_body:
+            return
+        remaining = end - start + 1
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # the player closes the connection when it seeks
+            pass
+
+    def do_GET(self):
+        self._send_file(send_body=True)
+
+    def do_HEAD(self):
+        self._send_file(send_body=False)
+
+    def log_message(self, format, *args):
+        logging.debug(f'{self.address_string()} {format % args}')
+
+
+def file_url(file_path: str, download_name: str = None, root: str = DATA_FOLDER, base_url: str = FILES_URL) -> str:
+    """
+    URL of a file under root on the file server
+    :param file_path:
+    :param download_name: if set, the browser saves the file under this name instead of playing it
+    :param root:
+    :param base_url:
+    :return:
+    """
+    relative_path = Path(file_path).resolve().relative_to(Path(root).resolve())
+    url = f'{base_url.rstrip("/")}/{quote(relative_path.as_posix())}'
+    if download_name:
+        url += f'?download={quote(download_name)}'
+    return url
+
+
+def publish(file_path: str, root: str = DATA_FOLDER) -> Optional[Path]:
+    """
+    Hard link of the file in the downloads folder, so the server gives access to it and to nothing else
+    next to it; the link is made again when the file is replaced
+    :return: None if the file cannot be linked, e.g. it is on another file system
+    """
+    path = Path(root) / DOWNLOADS_FOLDER / Path(file_path).name
+    try:
+        if not (path.exists() and os.path.samefile(path, file_path)):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}')
+            os.link(file_path, temporary_path)
+            os.replace(temporary_path, path)
+    except OSError as e:
+        logging.warning(f'Cannot publish {file_path} for download: {e}')
+        return None
+    return path
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_failed = False
+_server_lock = threading.Lock()
+
+
+def get_file_server(host: str = FILES_HOST, port: int = FILES_PORT, root: str = DATA_FOLDER,
+                    enabled: bool = FILES_ENABLED) -> Optional[ThreadingHTTPServer]:
+    """
+    The server shared by all the sessions, started on first use
+    :return: None if the server is not enabled or cannot listen, the files are then given to Streamlit
+    """
+    global _server, _server_failed
+    with _server_lock:
+        if _server is None and enabled and not _server_failed:
+            handler = type('DataRequestHandler', (RangeRequestHandler,), {'root': Path(root)})
+            try:
+                _server = ThreadingHTTPServer((host, port), handler)
+            except OSError as e:
+                logging.warning(f'Cannot serve the files on {host}:{port}, Streamlit serves them: {e}')
+                _server_failed = True
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name='file-server', daemon=True).start()
+            logging.info(f'Serving {", ".join(SERVED_FOLDERS)} of {root} on {host}:{port}')
+        return _server
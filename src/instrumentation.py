@@ -0,0 +1,330 @@
+"""
+Lightweight timing and resource instrumentation of the pipeline.
+
+Spans time a stage (or an AWS call) and record the peak RSS of the process while the stage runs:
+on Linux the high-water mark of the process is reset when a span starts (/proc/self/clear_refs)
+and read when a span starts or ends, elsewhere only the RSS at the start and at the end is seen.
+Counters accumulate frames, API calls, uploaded bytes, cache hits and so on.
+Every span is added to per stage totals, only the last TTA_TRACE_MAX_SPANS spans are kept one by one,
+so tracing can stay on in the long-running app and job processes.
+Everything is disabled unless TTA_TRACE=1 is set (or enable() is called); disabled spans and
+counters cost one global check. With TTA_TRACE_DIR set the trace is written there at exit:
+
+    TTA_TRACE=1 TTA_TRACE_DIR=artifacts/trace python main.py process video.mp4
+"""
+import atexit
+import functools
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+MAX_SPANS = int(os.environ.get('TTA_TRACE_MAX_SPANS', 10000))
+_spans: deque = deque(maxlen=MAX_SPANS)
+# (name, parent) -> calls, seconds and peak RSS of all the spans
+_stages: dict[tuple, dict] = {}
+_counters: defaultdict = defaultdict(float)
+_gauges: dict = {}
+_origin = time.perf_counter()
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# spans of all the threads that are open, they share the high-water mark of the process
+_open_spans: set = set()
+_can_reset_peak = True
+_process_peak = 0
+
+
+def rss_bytes() -> int:
+    """
+    Current RSS of the process; 0 where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return 0
+
+
+def _high_water_mark() -> int:
+    """
+    Peak RSS of the process since the last reset (VmHWM); 0 where /proc is not available
+    """
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _reset_high_water_mark():
+    global _can_reset_peak
+    if not _can_reset_peak:
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        _can_reset_peak = False
+
+
+def _update_peaks(current: int):
+    """
+    Fold the high-water mark since the last reset into the peak of the open spans and of the process;
+    called with _lock held
+    """
+    global _process_peak
+    peak = max(_high_water_mark() if _can_reset_peak else 0, current)
+    _process_peak = max(_process_peak, peak)
+    for open_span in _open_spans:
+        open_span.peak_rss = max(open_span.peak_rss, peak)
+
+
+def process_peak_rss_bytes() -> int:
+    """
+    Peak RSS over the whole life of the process, not of a single stage
+    """
+    if resource is None:
+        return _process_peak
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS; the resets of the spans lower it on linux, hence _process_peak
+    return max(usage if os.uname().sysname == 'Darwin' else usage * 1024, _process_peak)
+
+
+class _Span:
+    __slots__ = ('name', 'parent', 'attributes', 'start', 'start_rss', 'peak_rss')
+
+    def __init__(self, name: str, parent: Optional[str], attributes: dict):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start = 0.0
+        self.start_rss = 0
+        self.peak_rss = 0
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self.name)
+        self.start_rss = rss_bytes()
+        with _lock:
+            _update_peaks(self.start_rss)
+            _reset_high_water_mark()
+            self.peak_rss = self.start_rss
+            _open_spans.add(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        stack = _local.stack
+        stack.pop()
+        end_rss = rss_bytes()
+        record = {
+            'name': self.name,
+            'parent': stack[-1] if stack else self.parent,
+            'start': self.start - _origin,
+            'duration': end - self.start,
+            'rss_start_bytes': self.start_rss,
+            'rss_end_bytes': end_rss,
+            'thread': threading.current_thread().name,
+            'error': exc_type.__name__ if exc_type is not None else None,
+        }
+        if self.attributes:
+            record['attributes'] = self.attributes
+        with _lock:
+            _update_peaks(end_rss)
+            _open_spans.discard(self)
+            record['peak_rss_bytes'] = self.peak_rss
+            _spans.append(record)
+            stage = _stages.get((record['name'], record['parent']))
+            if stage is None:
+                stage = _stages[record['name'], record['parent']] = {'calls': 0, 'seconds': 0.0, 'peak_rss_bytes': 0}
+            stage['calls'] += 1
+            stage['seconds'] += record['duration']
+            stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], self.peak_rss)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable(trace_dir: str = None):
+    """
+    Start recording; the trace is exported to trace_dir at exit if it is set
+    """
+    global _enabled
+    _enabled = True
+    if trace_dir:
+        atexit.register(export, trace_dir)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _stages.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def span(name: str, parent: str = None, **attributes):
+    """
+    Context manager timing the block
+    :param name: stage name, e.g. 'transcribe' or 'aws.translate.translate_text'
+    :param parent: parent of a span opened outside of any other span of its thread, e.g. in a worker thread
+    :param attributes: extra values stored with the span
+    :return:
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, parent, attributes)
+
+
+def traced(name: str = None):
+    """
+    Decorator timing every call of the function
+    :param name: span name, the qualified function name by default
+    :return:
+    """
+
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name, None, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, value: float = 1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name: str, value: float):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot() -> dict:
+    """
+    :return: the last MAX_SPANS spans, the totals by stage name and parent, counters and gauges
+    """
+    with _lock:
+        stages = [{'name': name, 'parent': parent, **stage} for (name, parent), stage in _stages.items()]
+        return {'spans': list(_spans), 'stages': stages, 'counters': dict(_counters), 'gauges': dict(_gauges)}
+
+
+def export_json(file_path: str):
+    """
+    Write the last MAX_SPANS spans in the Chrome trace event format (chrome://tracing, Perfetto)
+    with the counters and gauges as metadata
+    """
+    data = snapshot()
+    events = []
+    for record in data['spans']:
+        events.append({
+            'name': record['name'],
+            'ph': 'X',
+            'ts': record['start'] * 1e6,
+            'dur': record['duration'] * 1e6,
+            'pid': os.getpid(),
+            'tid': record['thread'],
+            'args': {key: value for key, value in record.items() if key not in ('name', 'start', 'duration')},
+        })
+    with open(file_path, 'w') as f:
+        json.dump({'traceEvents': events, 'otherData': {'counters': data['counters'], 'gauges': data['gauges']}}, f)
+
+
+def _metric_name(name: str) -> str:
+    return 'tta_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def export_prometheus(file_path: str):
+    """
+    Write the aggregated spans, counters and gauges in the Prometheus text format
+    (e.g. for the node exporter textfile collector)
+    """
+    data = snapshot()
+    seconds = defaultdict(float)
+    calls = defaultdict(int)
+    peak_rss = defaultdict(int)
+    for stage in data['stages']:
+        seconds[stage['name']] += stage['seconds']
+        calls[stage['name']] += stage['calls']
+        peak_rss[stage['name']] = max(peak_rss[stage['name']], stage['peak_rss_bytes'])
+
+    lines = [
+        '# HELP tta_span_seconds_total Time spent in the stage.',
+        '# TYPE tta_span_seconds_total counter',
+    ]
+    lines += [f'tta_span_seconds_total{{span="{name}"}} {value:.6f}' for name, value in seconds.items()]
+    lines += ['# HELP tta_span_calls_total Number of times the stage ran.', '# TYPE tta_span_calls_total counter']
+    lines += [f'tta_span_calls_total{{span="{name}"}} {value}' for name, value in calls.items()]
+    lines += ['# HELP tta_span_peak_rss_bytes Peak RSS of the process while the stage ran.',
+              '# TYPE tta_span_peak_rss_bytes gauge']
+    lines += [f'tta_span_peak_rss_bytes{{span="{name}"}} {value}' for name, value in peak_rss.items()]
+    lines += ['# HELP tta_process_peak_rss_bytes Peak RSS of the process.', '# TYPE tta_process_peak_rss_bytes gauge',
+              f'tta_process_peak_rss_bytes {process_peak_rss_bytes()}']
+    for name, value in data['counters'].items():
+        lines += [f'# TYPE {_metric_name(name)}_total counter', f'{_metric_name(name)}_total {value}']
+    for name, value in data['gauges'].items():
+        lines += [f'# TYPE {_metric_name(name)} gauge', f'{_metric_name(name)} {value}']
+    with open(file_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def export(trace_dir: str):
+    """
+    Write trace.json and metrics.prom to trace_dir
+    """
+    Path(trace_dir).mkdir(parents=True, exist_ok=True)
+    export_json(str(Path(trace_dir) / 'trace.json'))
+    export_prometheus(str(Path(trace_dir) / 'metrics.prom'))
+
+
+if os.environ.get('TTA_TRACE', '') not in ('', '0'):
+    enable(os.environ.get('TTA_TRACE_DIR'))
@@ -0,0 +1,218 @@
+"""
+Local background jobs for the Streamlit app.
+
+Jobs run in a small pool of worker processes owned by the Streamlit server; the pool size caps the
+number of heavy jobs running at once. The state of every job is a json file, so any session
+(and a reloaded page) polls the same job. Job ids are derived from the video content hash and
+the languages, which makes submitting the same video twice attach to the running job.
+The low bitrate previews shown by the app are encoded here too, never in the script thread.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Optional
+
+from bundle import Bundle, bundle_path
+from pipeline import STAGES as PIPELINE_STAGES, process
+from preview import create_preview
+from store import atomic_write, save_results
+
+JOBS_FOLDER = 'data/jobs'
+MAX_CONCURRENT_JOBS = int(os.environ.get('TTA_MAX_JOBS', 2))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STAGES = PIPELINE_STAGES + ('create preview',)
+
+
+def video_job_id(digest: str, source_language: str, target_language: str) -> str:
+    return f'{digest}-{source_language}-{target_language}'
+
+
+def preview_job_id(video_path: str) -> str:
+    return 'preview-' + hashlib.sha1(str(Path(video_path).resolve()).encode('utf-8')).hexdigest()
+
+
+def _job_path(job_id: str, jobs_folder: str = JOBS_FOLDER) -> Path:
+    return Path(jobs_folder) / f'{job_id}.json'
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load_job(job_id: str, jobs_folder: str = JOBS_FOLDER) -> Optional[dict]:
+    path = _job_path(job_id, jobs_folder)
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def read_job(job_id: str, jobs_folder: str = JOBS_FOLDER) -> Optional[dict]:
+    """
+    State of the job: status, stage, progress (0-1), error and timestamps
+    :param job_id:
+    :param jobs_folder:
+    :return: None if the job was never submitted
+    """
+    job = _load_job(job_id, jobs_folder)
+    if job is None:
+        return None
+    if job['status'] in (QUEUED, RUNNING) and not _pid_alive(job['pid']):
+        job['status'] = FAILED
+        job['error'] = 'The worker process stopped before the job completed'
+    return job
+
+
+def write_job(job_id: str, jobs_folder: str = JOBS_FOLDER, **fields):
+    job = read_job(job_id, jobs_folder) or {'id': job_id, 'created': time.time()}
+    job.update(fields, updated=time.time())
+    data = json.dumps(job).encode('utf-8')
+    atomic_write(_job_path(job_id, jobs_folder), lambda f: f.write(data))
+    return job
+
+
+def run_video_job(job_id: str, digest: str, video_path: str, source_language: str, target_language: str,
+                  jobs_folder: str = JOBS_FOLDER):
+    """
+    Worker side of a video job: run the pipeline of pipeline.py, encode the preview of the output and report
+    every stage in the job state
+    """
+    def stage(name: str):
+        write_job(job_id, jobs_folder, status=RUNNING, pid=os.getpid(), stage=name,
+                  progress=STAGES.index(name) / len(STAGES))
+
+    try:
+        # from now on the job fails as soon as this worker dies, see read_job
+        write_job(job_id, jobs_folder, status=RUNNING, pid=os.getpid(), stage=None, progress=0.0)
+        output_path, _ = process(video_path, source_language, target_language, on_stage=stage)
+        stage('create preview')
+        create_preview(output_path)
+        # the session results of the app, the bundle next to the video has the speaker turns and is indexed
+        with Bundle(bundle_path(video_path)) as bundle:
+            results = {'video_path': output_path, 'source_items': bundle.items('segments'),
+                       'translated_items': bundle.items(f'translations/{target_language}')}
+        save_results(digest, source_language, target_language, results)
+        write_job(job_id, jobs_folder, status=DONE, stage=None, progress=1.0)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        write_job(job_id, jobs_folder, status=FAILED, error=f'{type(e).__name__}: {e}')
+
+
+def run_preview_job(job_id: str, video_path: str, jobs_folder: str = JOBS_FOLDER):
+    """
+    Worker side of a preview job: encode the low bitrate preview of a video, see preview.py
+    """
+    try:
+        write_job(job_id, jobs_folder, status=RUNNING, pid=os.getpid(), stage='create preview', progress=0.0)
+        create_preview(video_path)
+        write_job(job_id, jobs_folder, status=DONE, stage=None, progress=1.0)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        write_job(job_id, jobs_folder, status=FAILED, error=f'{type(e).__name__}: {e}')
+
+
+class JobQueue:
+    """
+    Pool of worker processes running the video jobs
+    """
+
+    def __init__(self, max_workers: int = MAX_CONCURRENT_JOBS, jobs_folder: str = JOBS_FOLDER):
+        self.jobs_folder = jobs_folder
+        self.max_workers = max_workers
+        self._executor = self._create_executor()
+        self._lock = threading.Lock()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _submit(self, job_id: str, function, *args):
+        try:
+            future = self._executor.submit(function, *args)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for memory), the pool refuses all work until it is replaced
+            logging.warning('The job worker pool is broken, starting a new one')
+            self._executor.shutdown(wait=False)
+            self._executor = self._create_executor()
+            future = self._executor.submit(function, *args)
+        future.add_done_callback(lambda done: self._on_done(job_id, done))
+
+    def _on_done(self, job_id: str, future: Future):
+        """
+        Mark the job failed when its worker could not report it, e.g. the worker died and broke the pool
+        """
+        error = CancelledError() if future.cancelled() else future.exception()
+        if error is None:
+            return
+        job = _load_job(job_id, self.jobs_folder)
+        if job is not None and job['status'] in (DONE, FAILED):
+            return
+        logging.error(f'Job {job_id} failed in the pool: {type(error).__name__}: {error}')
+        write_job(job_id, self.jobs_folder, status=FAILED, error=f'{type(error).__name__}: {error}')
+
+    def submit_video(self, digest: str, video_path: str, source_language: str, target_language: str) -> str:
+        """
+        Submit the processing of a video unless the same job is already queued or running
+        :return: job id
+        """
+        job_id = video_job_id(digest, source_language, target_language)
+        with self._lock:
+            job = read_job(job_id, self.jobs_folder)
+            if job is not None and job['status'] in (QUEUED, RUNNING):
+                return job_id
+            write_job(job_id, self.jobs_folder, status=QUEUED, pid=os.getpid(), stage=None, progress=0.0,
+                      error=None)
+            self._submit(job_id, run_video_job, job_id, digest, video_path, source_language, target_language,
+                         self.jobs_folder)
+        return job_id
+
+    def submit_preview(self, video_path: str) -> str:
+        """
+        Submit the encoding of the preview of a video unless it is already queued or running
+        :return: job id
+        """
+        job_id = preview_job_id(video_path)
+        with self._lock:
+            job = read_job(job_id, self.jobs_folder)
+            if job is not None and job['status'] in (QUEUED, RUNNING):
+                return job_id
+            write_job(job_id, self.jobs_folder, status=QUEUED, pid=os.getpid(), stage=None, progress=0.0,
+                      error=None)
+            self._submit(job_id, run_preview_job, job_id, video_path, self.jobs_folder)
+        return job_id
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    """
+    The queue shared by all the sessions of the server process
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
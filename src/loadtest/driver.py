@@ -0,0 +1,136 @@
+"""
+Push synthetic videos through main.process against the simulated AWS services and report throughput,
+tail latency and API call counts:
+
+    python -m loadtest.driver --videos=50 --concurrency=8 --translate_rate_limit=20 --failure_rate=0.01
+
+Everything runs in a temporary working directory, so the caches and the translation memory start empty.
+Times are reported in simulated seconds (see loadtest.fake_aws.FakeAWS.time_scale).
+"""
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from fire import Fire
+
+import services
+from loadtest.fake_aws import BYTES_PER_SECOND, FakeAWS
+from pipeline import process
+
+
+def create_videos(folder: str, videos: int, media_seconds: float, seed: int = 0) -> list[str]:
+    """
+    Files standing in for the videos, their size encodes the media duration for the fake Transcribe
+    :param folder:
+    :param videos:
+    :param media_seconds: mean duration, the durations vary by +-50%
+    :param seed:
+    :return: paths
+    """
+    rng = random.Random(seed)
+    paths = []
+    for index in range(videos):
+        path = Path(folder) / f'video-{index:04}.mp4'
+        seconds = media_seconds * rng.uniform(0.5, 1.5)
+        path.write_bytes(b'\0' * int(seconds * BYTES_PER_SECOND))
+        paths.append(str(path))
+    return paths
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def load_test(videos: int = 20, concurrency: int = 4, media_seconds: float = 600, source_language='es-ES',
+              target_language='en-US', time_scale: float = 0.001, throttling_rate: float = 0.0,
+              failure_rate: float = 0.0, job_failure_rate: float = 0.0, translate_rate_limit: float = None,
+              seed: int = 0, output_path: str = None) -> dict:
+    """
+    Process the synthetic videos concurrently with the fake services
+    :param videos: number of videos
+    :param concurrency: videos processed at the same time
+    :param media_seconds: mean video duration
+    :param source_language:
+    :param target_language: one language or several ('en-US,fr-FR'), see main.process
+    :param time_scale: real seconds per simulated second
+    :param throttling_rate: probability of a ThrottlingException on any API call
+    :param failure_rate: probability of a transient failure on any API call
+    :param job_failure_rate: probability of a Transcribe job failing
+    :param translate_rate_limit: Translate requests per simulated second, no limit if not set
+    :param seed:
+    :param output_path: optional json file for the report
+    :return: report
+    """
+    fake = FakeAWS(time_scale=time_scale, throttling_rate=throttling_rate, failure_rate=failure_rate,
+                   job_failure_rate=job_failure_rate, translate_rate_limit=translate_rate_limit, seed=seed)
+    if output_path is not None:
+        output_path = os.path.abspath(output_path)
+    working_directory = os.getcwd()
+    latencies = []
+    failures = {}
+
+    def run(video_path: str):
+        start = fake.clock()
+        try:
+            process(video_path, source_language, target_language)
+        except Exception as e:
+            logging.debug(traceback.format_exc())
+            failures[Path(video_path).name] = f'{type(e).__name__}: {e}'
+            return
+        latencies.append(fake.clock() - start)
+
+    with tempfile.TemporaryDirectory() as folder, services.use(fake):
+        os.chdir(folder)
+        try:
+            paths = create_videos(folder, videos, media_seconds, seed)
+            started = fake.clock()
+            real_started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(run, paths))
+            elapsed = fake.clock() - started
+            real_elapsed = time.perf_counter() - real_started
+        finally:
+            os.chdir(working_directory)
+
+    report = {
+        'videos': videos,
+        'completed': len(latencies),
+        'failed': len(failures),
+        'concurrency': concurrency,
+        'simulated_seconds': elapsed,
+        'real_seconds': real_elapsed,
+        'videos_per_hour': len(latencies) / elapsed * 3600 if elapsed else 0.0,
+        'latency_seconds': {name: percentile(latencies, q) for name, q in
+                            [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]},
+        'api_calls': dict(sorted(fake.calls.items())),
+        'api_errors': dict(sorted(fake.errors.items())),
+        'failures': failures,
+    }
+    print(f'{report["completed"]}/{videos} videos in {elapsed:.0f}s simulated ({real_elapsed:.1f}s real), '
+          f'{report["videos_per_hour"]:.1f} videos/hour')
+    print('latency ' + ', '.join(f'{name} {value:.0f}s' for name, value in report['latency_seconds'].items()
+                                 if value is not None))
+    for name, calls in report['api_calls'].items():
+        print(f'    {name:<40}{calls:>8}')
+    for name, errors in report['api_errors'].items():
+        print(f'    {name:<56}{errors:>8}')
+    for name, error in failures.items():
+        print(f'failed {name}: {error}')
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    Fire(load_test)
@@ -0,0 +1,239 @@
+"""
+In-process stand-ins for S3, Transcribe and Translate, for load tests without network or AWS costs.
+
+The fakes follow the boto3 call shapes used by the pipeline and raise botocore ClientErrors like
+the real services. Latencies are drawn from lognormal distributions in simulated seconds;
+`time_scale` maps them to real seconds, so a 10 minute Transcribe job with time_scale=0.001
+takes 0.6 s. Use it through services.use:
+
+    fake = FakeAWS(time_scale=0.001, translate_rate_limit=20, failure_rate=0.01)
+    with services.use(fake):
+        process('video.mp4')
+    print(fake.calls)
+"""
+import math
+import random
+import subprocess
+import threading
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+from benchmarks.fixtures import transcript
+
+# size of the synthetic media per second, the fake Transcribe derives the duration from it
+BYTES_PER_SECOND = 1024
+TRANSCRIPT_HOST = 'fake-transcribe.local'
+
+
+class Latency(NamedTuple):
+    # simulated seconds
+    median: float
+    # sigma of the lognormal distribution, 0 for a constant latency
+    spread: float = 0.5
+
+    def sample(self, rng: random.Random) -> float:
+        return self.median * math.exp(self.spread * rng.gauss(0, 1))
+
+
+LATENCIES = {
+    's3.head_object': Latency(0.03),
+    's3.upload_file': Latency(0.2),
+    'transcribe.start_transcription_job': Latency(0.15),
+    'transcribe.get_transcription_job': Latency(0.08),
+    'transcribe.download': Latency(0.2),
+    'translate.translate_text': Latency(0.12, 0.4),
+    'ffmpeg': Latency(5.0, 0.3),
+}
+
+
+def _error(code: str, operation: str, message: str = '') -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+
+class _TokenBucket:
+    """
+    Requests per simulated second allowed by a service, with a one second burst
+    """
+
+    def __init__(self, rate: float, clock):
+        self.rate = rate
+        self.tokens = rate
+        self.clock = clock
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class FakeAWS:
+
+    def __init__(self, time_scale: float = 0.01, latencies: dict[str, Latency] = None,
+                 transcribe_speed: Latency = Latency(0.25, 0.3), upload_speed: Latency = Latency(0.05, 0.3),
+                 throttling_rate: float = 0.0, failure_rate: float = 0.0, job_failure_rate: float = 0.0,
+                 translate_rate_limit: Optional[float] = None, seed: int = 0):
+        """
+        :param time_scale: real seconds per simulated second
+        :param latencies: latency per operation, merged into LATENCIES
+        :param transcribe_speed: duration of a Transcribe job per second of media
+        :param upload_speed: duration of an S3 upload per second of media
+        :param throttling_rate: probability of a ThrottlingException on any API call
+        :param failure_rate: probability of a transient InternalServerException on any API call
+        :param job_failure_rate: probability of a Transcribe job ending FAILED
+        :param translate_rate_limit: Translate requests per simulated second before throttling, no limit if None
+        :param seed:
+        """
+        self.time_scale = time_scale
+        self.latencies = {**LATENCIES, **(latencies or {})}
+        self.transcribe_speed = transcribe_speed
+        self.upload_speed = upload_speed
+        self.throttling_rate = throttling_rate
+        self.failure_rate = failure_rate
+        self.job_failure_rate = job_failure_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self.objects: dict[tuple[str, str], int] = {}
+        self.jobs: dict[str, dict] = {}
+        self.transcripts: dict[str, dict] = {}
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._translate_bucket = _TokenBucket(translate_rate_limit, self.clock) if translate_rate_limit else None
+        self._clients = {'s3': _S3(self), 'transcribe': _Transcribe(self), 'translate': _Translate(self)}
+
+    def clock(self) -> float:
+        """
+        Simulated seconds since the creation of the fake
+        """
+        return (time.perf_counter() - self._origin) / self.time_scale
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds * self.time_scale)
+
+    def call(self, operation: str, extra_seconds: float = 0.0, bucket: _TokenBucket = None):
+        """
+        Count the call, wait its latency and inject the configured failures
+        """
+        with self.lock:
+            self.calls[operation] += 1
+            latency = self.latencies[operation].sample(self.rng) + extra_seconds
+            draw = self.rng.random()
+        self.sleep(latency)
+        if (bucket is not None and not bucket.take()) or draw < self.throttling_rate:
+            self._count_error(operation, 'ThrottlingException')
+            raise _error('ThrottlingException', operation, 'Rate exceeded')
+        if draw < self.throttling_rate + self.failure_rate:
+            self._count_error(operation, 'InternalServerException')
+            raise _error('InternalServerException', operation)
+
+    def _count_error(self, operation: str, code: str):
+        with self.lock:
+            self.errors[f'{operation}.{code}'] += 1
+
+    def client(self, service_name: str, **kwargs):
+        if service_name not in self._clients:
+            raise ValueError(f'No fake for the {service_name} service, expected one of {list(self._clients)}')
+        return self._clients[service_name]
+
+    def fetch_json(self, url: str):
+        self.call('transcribe.download')
+        job_name = Path(urlparse(url).path).stem
+        if job_name not in self.transcripts:
+            raise RuntimeError(f'No transcript at {url}')
+        return self.transcripts[job_name]
+
+    def run(self, command: list[str], **kwargs) -> subprocess.CompletedProcess:
+        with self.lock:
+            self.calls[command[0]] += 1
+            latency = self.latencies['ffmpeg'].sample(self.rng)
+        self.sleep(latency)
+        return subprocess.CompletedProcess(command, 0, b'', b'')
+
+
+class _S3:
+
+    def __init__(self, aws: FakeAWS):
+        self.aws = aws
+
+    def head_object(self, Bucket: str, Key: str):
+        self.aws.call('s3.head_object')
+        if (Bucket, Key) not in self.aws.objects:
+            raise _error('404', 'HeadObject', 'Not Found')
+        return {'ContentLength': self.aws.objects[(Bucket, Key)]}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, **kwargs):
+        size = Path(Filename).stat().st_size
+        self.aws.call('s3.upload_file', size / BYTES_PER_SECOND * self.aws.upload_speed.sample(self.aws.rng))
+        self.aws.objects[(Bucket, Key)] = size
+
+
+class _Transcribe:
+
+    def __init__(self, aws: FakeAWS):
+        self.aws = aws
+
+    def start_transcription_job(self, TranscriptionJobName: str, Media: dict, LanguageCode: str, **kwargs):
+        self.aws.call('transcribe.start_transcription_job')
+        uri = urlparse(Media['MediaFileUri'])
+        key = (uri.netloc, uri.path.lstrip('/'))
+        if key not in self.aws.objects:
+            raise _error('BadRequestException', 'StartTranscriptionJob', f'{Media["MediaFileUri"]} does not exist')
+        with self.aws.lock:
+            if TranscriptionJobName in self.aws.jobs:
+                raise _error('ConflictException', 'StartTranscriptionJob', 'The job name already exists')
+            media_seconds = self.aws.objects[key] / BYTES_PER_SECOND
+            job = {
+                'TranscriptionJobName': TranscriptionJobName,
+                'LanguageCode': LanguageCode,
+                'Media': Media,
+                'TranscriptionJobStatus': 'IN_PROGRESS',
+                'media_seconds': media_seconds,
+                'done_at': self.aws.clock() + media_seconds * self.aws.transcribe_speed.sample(self.aws.rng),
+                'fails': self.aws.rng.random() < self.aws.job_failure_rate,
+            }
+            self.aws.jobs[TranscriptionJobName] = job
+        return {'TranscriptionJob': self._public(job)}
+
+    def get_transcription_job(self, TranscriptionJobName: str):
+        self.aws.call('transcribe.get_transcription_job')
+        job = self.aws.jobs.get(TranscriptionJobName)
+        if job is None:
+            raise _error('BadRequestException', 'GetTranscriptionJob', 'The requested job could not be found')
+        if job['TranscriptionJobStatus'] == 'IN_PROGRESS' and self.aws.clock() >= job['done_at']:
+            if job['fails']:
+                job['TranscriptionJobStatus'] = 'FAILED'
+                job['FailureReason'] = 'Injected failure'
+            else:
+                self.aws.transcripts[TranscriptionJobName] = transcript(
+                    job['media_seconds'], seed=zlib.crc32(TranscriptionJobName.encode()))
+                job['Transcript'] = {'TranscriptFileUri': f'https://{TRANSCRIPT_HOST}/{TranscriptionJobName}.json'}
+                job['TranscriptionJobStatus'] = 'COMPLETED'
+        return {'TranscriptionJob': self._public(job)}
+
+    @staticmethod
+    def _public(job: dict) -> dict:
+        return {key: value for key, value in job.items() if key not in ('media_seconds', 'done_at', 'fails')}
+
+
+class _Translate:
+
+    def __init__(self, aws: FakeAWS):
+        self.aws = aws
+
+    def translate_text(self, Text: str, SourceLanguageCode: str, TargetLanguageCode: str, **kwargs):
+        self.aws.call('translate.translate_text', bucket=self.aws._translate_bucket)
+        return {'TranslatedText': f'[{TargetLanguageCode}] {Text}', 'SourceLanguageCode': SourceLanguageCode,
+                'TargetLanguageCode': TargetLanguageCode}
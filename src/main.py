@@ -1,46 +1,114 @@
+import csv
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Sequence, Union
 
+import numpy as np
 from fire import Fire
-from joblib import Parallel, delayed
 
-from dto import AWSItem, Item
-from faces.faces import process as process_faces
-from faces.utils import save_translated_items
-from subtitles.subtitles import create_subtitle, create_subtitles_file, write_srt_to_file
-from transcribe.amazon import transcribe
-from translate.translate import translate_item
-from utils import create_markdown
+from bundle import BundleWriter, bundle_path
+from faces.faces import process as process_faces, timeline_gap
+from instrumentation import enable, snapshot
+from pipeline import process
+from store import atomic_write
 
 os.environ['AWS_PROFILE'] = 'EDU'
 os.environ['AWS_REGION'] = 'us-east-1'
 os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
 
 
-def process(video_path: str, source_language='es-ES', target_language: str = 'en-US') -> str:
+def stage_durations(root: str) -> list[tuple[str, float]]:
     """
-    Process a video.
+    Total duration of the stages directly under the root span, longest first
     """
-    transcription = transcribe(video_path, language=source_language)
+    durations = {}
+    for stage in snapshot()['stages']:
+        if stage['parent'] == root:
+            durations[stage['name']] = durations.get(stage['name'], 0.0) + stage['seconds']
+    return sorted(durations.items(), key=lambda item: item[1], reverse=True)
 
-    subtitles_file_path = Path(video_path).with_suffix('.srt')
 
-    grouped_items: list[AWSItem] = create_subtitle(transcription, subtitles_file_path)
-    translated_items: list[Item] = Parallel(n_jobs=15)(
-        delayed(translate_item)(item, source_language, target_language) for item in grouped_items)
-    save_translated_items(subtitles_file_path.parent / 'translated_item', translated_items)
-    subtitles_file_path = Path(video_path).with_suffix('.en.srt')
-    create_subtitles_file(str(subtitles_file_path), translated_items)
-    output_path = str(Path(video_path).with_suffix('.en.mp4'))
-    write_srt_to_file(video_path, str(subtitles_file_path), output_path)
-    markdown = create_markdown(translated_items)
-    return output_path, markdown
-    # group the items by 5000 bytes content
+def _faces_branch(video_path: str, **kwargs):
+    """
+    Face branch of process_all, run in its own process
+    :return: people timelines, names and mean embeddings of the people, duration and stages
+    """
+    enable()
+    started = time.perf_counter()
+    persons = process_faces(video_path, show=False, **kwargs)
+    max_gap = timeline_gap(**kwargs)
+    rows = []
+    for person in persons.values():
+        rows.extend(person.showed_times(max_gap).to_dict('records'))
+    names = list(persons)
+    embeddings = np.array([persons[name].mean_face() for name in names], dtype=np.float32)
+    return rows, names, embeddings, time.perf_counter() - started, stage_durations('process_faces')
+
+
+def process_all(video_path: str, source_language='es-ES', target_language: Union[str, Sequence[str]] = 'en-US',
+                chunk_seconds: float = None, threshold=0.6, profile=None, scene_threshold=None):
+    """
+    Run the audio branch (transcription, translation, subtitles) and the face branch at the same time.
+    The audio branch mostly waits on AWS, so the faces are analyzed in a separate process meanwhile
+    and the total time is close to the longest branch instead of the sum of both.
+    :param video_path:
+    :param source_language:
+    :param target_language: see process
+    :param chunk_seconds: see process
+    :param threshold: face matching threshold, see faces.faces.process
+    :param profile: face inference profile, see faces.models.PROFILES
+    :param scene_threshold: see faces.faces.process
+    :return: outputs of both branches and their durations
+    """
+    enable()
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        faces_future = executor.submit(_faces_branch, video_path, threshold=threshold, profile=profile,
+                                       scene_threshold=scene_threshold)
+        output_path, markdown = process(video_path, source_language, target_language, chunk_seconds)
+        audio_seconds = time.perf_counter() - started
+        audio_stages = stage_durations('process')
+        audio_stages += [(f'stream_subtitles/{name}', duration)
+                         for name, duration in stage_durations('stream_subtitles')]
+        rows, names, embeddings, faces_seconds, faces_stages = faces_future.result()
+    wall_seconds = time.perf_counter() - started
+
+    people_path = str(Path(video_path).with_suffix('.people.csv'))
+    with open(people_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['name', 'start_time', 'end_time'])
+        writer.writeheader()
+        writer.writerows(sorted(rows, key=lambda row: row['start_time']))
+    bundle_writer = BundleWriter.from_bundle(bundle_path(video_path))
+    bundle_writer.add_people(names, embeddings, rows)
+    atomic_write(bundle_path(video_path), bundle_writer.write)
+
+    branches = {'audio': (audio_seconds, audio_stages), 'faces': (faces_seconds, faces_stages)}
+    critical = max(branches, key=lambda branch: branches[branch][0])
+    for branch, (seconds, stages) in branches.items():
+        marker = ' (critical path)' if branch == critical else ''
+        print(f'{branch} branch: {seconds:.1f}s{marker}')
+        for name, duration in stages:
+            print(f'    {name}: {duration:.1f}s')
+    sequential = audio_seconds + faces_seconds
+    print(f'wall time {wall_seconds:.1f}s, sequential {sequential:.1f}s, '
+          f'saved {sequential - wall_seconds:.1f}s')
+    return {
+        'video_path': output_path,
+        'markdown': markdown,
+        'people_path': people_path,
+        'bundle_path': str(bundle_path(video_path)),
+        'critical_path': critical,
+        'seconds': {'audio': audio_seconds, 'faces': faces_seconds, 'wall': wall_seconds},
+    }
 
 
 if __name__ == '__main__':
     Fire({
         'process': process,
+        'process_all': process_all,
         'process_faces': process_faces,
     }
     )
@@ -0,0 +1,222 @@
+"""
+Processing pipeline of a video, shared by the command line (main.py) and the job workers (jobs.py).
+
+The transcript is split into segments that stream, without waiting for the whole list, into the
+export of the source subtitles and into the translation and export of every target language.
+Each consumer runs in its own thread and gets the segments through a bounded queue, so a slow
+consumer makes the segmentation wait instead of the segments piling up in memory. The subtitles
+are then burned or muxed into the video and everything is saved in the bundle next to it.
+"""
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Sequence, TypeVar, Union
+
+from bundle import BundleWriter, bundle_path
+from dto import Item
+from instrumentation import gauge, span, traced
+from search import get_index
+from store import atomic_write
+from subtitles.export import export, export_paths
+from subtitles.subtitles import iter_subtitles, mux_subtitle_tracks, write_srt_to_file
+from transcribe.amazon import transcribe
+from transcribe.chunked import transcribe_chunked
+from translate.translate import translate_stream
+
+QUEUE_SIZE = 64
+STAGES = ('transcribe', 'translate and export subtitles', 'burn subtitles')
+_END = object()
+
+T = TypeVar('T')
+
+
+class _Failed:
+    __slots__ = ('error',)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class Channel:
+    """
+    Bounded queue of items from one producer to one consumer, iterated until the producer closes it
+    """
+
+    def __init__(self, maxsize: int = QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize)
+        self.closed = False
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def close(self, error: Optional[BaseException] = None):
+        self._queue.put(_END if error is None else _Failed(error))
+
+    def __iter__(self) -> Iterator:
+        while not self.closed:
+            item = self._queue.get()
+            if item is _END:
+                self.closed = True
+                return
+            if isinstance(item, _Failed):
+                self.closed = True
+                raise item.error
+            yield item
+
+    def drain(self):
+        """
+        Drop the items until the producer closes the channel, so it never waits on a consumer that stopped
+        """
+        try:
+            for _ in self:
+                pass
+        except BaseException:
+            pass
+
+
+def _consume(consumer: Callable[[Iterator], T], channel: Channel) -> T:
+    try:
+        return consumer(iter(channel))
+    finally:
+        channel.drain()
+
+
+def fan_out(source: Iterable, consumers: list[Callable[[Iterator], T]], queue_size: int = QUEUE_SIZE) -> list[T]:
+    """
+    Feed every item of the source to all the consumers, each running in its own thread
+    :param source: iterated once, in the calling thread
+    :param consumers: functions of an iterator over the items
+    :param queue_size: items buffered per consumer
+    :return: results of the consumers, in their order
+    :raises: the error of the source, or else the error of the first failed consumer
+    """
+    channels = [Channel(queue_size) for _ in consumers]
+    with ThreadPoolExecutor(max_workers=len(consumers)) as pool:
+        futures = [pool.submit(_consume, consumer, channel) for consumer, channel in zip(consumers, channels)]
+        try:
+            for item in source:
+                for channel in channels:
+                    channel.put(item)
+        except BaseException as e:
+            for channel in channels:
+                channel.close(e)
+            raise
+        for channel in channels:
+            channel.close()
+        return [future.result() for future in futures]
+
+
+def parse_languages(languages: Union[str, Sequence[str]]) -> list[str]:
+    """
+    Languages from python code or from the command line ('en-US,fr-FR')
+    """
+    if isinstance(languages, str):
+        languages = languages.split(',')
+    return [language.strip() for language in languages if language.strip()]
+
+
+def language_suffixes(languages: list[str]) -> dict[str, str]:
+    """
+    File suffix per language: the primary subtag ('en' for 'en-US') unless two languages share it
+    """
+    primary = [language.split('-')[0].lower() for language in languages]
+    return {language: tag if primary.count(tag) == 1 else language.lower()
+            for language, tag in zip(languages, primary)}
+
+
+def _export_items(items: Iterable[Item], paths: dict[str, str], metric: str = None,
+                  started: float = None) -> list[Item]:
+    """
+    Export the items as they come; the files are moved in place once complete, see export
+    :param metric: gauge of the seconds from started to the first item handed to the writers
+    :return: the items, for the bundle
+    """
+    collected = []
+
+    def collect():
+        for item in items:
+            if metric and not collected:
+                gauge(metric, time.perf_counter() - started)
+            collected.append(item)
+            yield item
+
+    export(collect(), paths)
+    return collected
+
+
+def _export_source(items: Iterable[Item], paths: dict[str, str]) -> list[Item]:
+    with span('export', parent='stream_subtitles'):
+        return _export_items(items, paths)
+
+
+def _translate_and_export(items: Iterable[Item], source_language: str, target_language: str, paths: dict[str, str],
+                          started: float) -> list[Item]:
+    with span('translate_export', parent='stream_subtitles', language=target_language):
+        return _export_items(translate_stream(items, source_language, target_language), paths,
+                             f'process.first_translated_segment_seconds.{target_language}', started)
+
+
+@traced('process')
+def process(video_path: str, source_language='es-ES', target_language: Union[str, Sequence[str]] = 'en-US',
+            chunk_seconds: float = None, on_stage: Callable[[str], None] = None):
+    """
+    Process a video.
+    :param video_path:
+    :param source_language:
+    :param target_language: one language or several ('en-US,fr-FR'); with several languages the video gets
+        one soft subtitle track per language instead of burned subtitles
+    :param chunk_seconds: if set, long media is transcribed as concurrent jobs over chunks of about this duration
+    :param on_stage: called with the name of every stage from STAGES when it starts
+    :return: output video path and the markdown (markdown by language with several languages);
+        everything is also saved in the bundle next to the video, see bundle.py
+    """
+    on_stage = on_stage or (lambda stage: None)
+    target_languages = parse_languages(target_language)
+    suffixes = language_suffixes(target_languages)
+    on_stage(STAGES[0])
+    if chunk_seconds:
+        transcription = transcribe_chunked(video_path, source_language, chunk_seconds)
+    else:
+        transcription = transcribe(video_path, language=source_language)
+
+    # segments stream into the source export and into the translation and export of every language
+    on_stage(STAGES[1])
+    started = time.perf_counter()
+    paths = {language: export_paths(Path(video_path).with_suffix(f'.{suffixes[language]}'))
+             for language in target_languages}
+    consumers = [partial(_export_source, paths=export_paths(Path(video_path).with_suffix('')))]
+    consumers += [partial(_translate_and_export, source_language=source_language, target_language=language,
+                          paths=paths[language], started=started) for language in target_languages]
+    with span('stream_subtitles'):
+        grouped_items, *translated = fan_out(iter_subtitles(transcription), consumers)
+    translations: dict[str, list[Item]] = dict(zip(target_languages, translated))
+
+    subtitles_paths = {}
+    markdowns = {}
+    for language in target_languages:
+        subtitles_paths[language] = paths[language]['srt']
+        with open(paths[language]['md'], 'r', encoding='utf-8') as f:
+            markdowns[language] = f.read()
+
+    on_stage(STAGES[2])
+    if len(target_languages) == 1:
+        language = target_languages[0]
+        output_path = str(Path(video_path).with_suffix(f'.{suffixes[language]}.mp4'))
+        write_srt_to_file(video_path, subtitles_paths[language], output_path)
+    else:
+        output_path = str(Path(video_path).with_suffix('.subtitled.mp4'))
+        mux_subtitle_tracks(video_path, subtitles_paths, output_path)
+
+    writer = BundleWriter({'video_path': output_path, 'source_video_path': str(video_path),
+                           'source_language': source_language, 'target_languages': target_languages})
+    writer.add_items('segments', grouped_items)
+    for language, translated_items in translations.items():
+        writer.add_items(f'translations/{language}', translated_items)
+    writer.add_speaker_turns(transcription)
+    atomic_write(bundle_path(video_path), writer.write)
+    get_index().index_bundle(bundle_path(video_path))
+    if len(target_languages) == 1:
+        return output_path, markdowns[target_languages[0]]
+    return output_path, markdowns
@@ -0,0 +1,103 @@
+"""
+Low bitrate preview proxies of the output videos, played in the app instead of the full resolution file.
+
+A proxy is encoded once per output content: it is cached under the sha256 of the output, and the
+digest itself is remembered next to the output (keyed by its size and mtime), so a rerun only stats
+the file instead of hashing gigabytes again. Hashing and encoding run in the job workers (see jobs.py),
+the app only looks the proxy up.
+"""
+import logging
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Optional
+
+import services
+from instrumentation import traced
+from store import path_digest
+
+PREVIEWS_FOLDER = 'data/previews'
+PREVIEW_HEIGHT = 360
+
+_locks: dict[str, threading.Lock] = {}
+_locks_lock = threading.Lock()
+
+
+def _digest_key(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return f'{stat.st_size} {stat.st_mtime_ns}'
+
+
+def known_digest(file_path: str) -> Optional[str]:
+    """
+    sha256 of the file stored next to it by content_digest, None if the file changed since or was never hashed
+    """
+    digest_path = Path(f'{file_path}.sha256')
+    if not digest_path.exists():
+        return None
+    stored_key, _, digest = digest_path.read_text().strip().rpartition(' ')
+    return digest if stored_key == _digest_key(file_path) else None
+
+
+def content_digest(file_path: str) -> str:
+    """
+    sha256 of the file, computed once per size and mtime and stored in a .sha256 file next to it
+    """
+    digest = known_digest(file_path)
+    if digest is not None:
+        return digest
+    key = _digest_key(file_path)
+    digest_path = Path(f'{file_path}.sha256')
+    digest = path_digest(file_path)
+    try:
+        digest_path.write_text(f'{key} {digest}')
+    except OSError:
+        logging.warning(f'Cannot write {digest_path}, the digest will be computed again')
+    return digest
+
+
+def preview_path(digest: str, height: int = PREVIEW_HEIGHT, previews_folder: str = PREVIEWS_FOLDER) -> Path:
+    return Path(previews_folder) / f'{digest}-{height}p.mp4'
+
+
+def cached_preview(video_path: str, height: int = PREVIEW_HEIGHT,
+                   previews_folder: str = PREVIEWS_FOLDER) -> Optional[str]:
+    """
+    Path of the preview if it was created for the current content of the video; never hashes the video
+    """
+    digest = known_digest(video_path)
+    if digest is None:
+        return None
+    path = preview_path(digest, height, previews_folder)
+    return str(path) if path.exists() else None
+
+
+@traced('ffmpeg.preview')
+def create_preview(video_path: str, height: int = PREVIEW_HEIGHT, crf: int = 32, audio_bitrate: str = '64k',
+                   previews_folder: str = PREVIEWS_FOLDER) -> str:
+    """
+    Encode the preview proxy of a video unless it exists already
+    :param video_path:
+    :param height: height of the proxy in pixels, the width keeps the aspect ratio
+    :param crf: x264 quality, higher is smaller
+    :param audio_bitrate:
+    :param previews_folder:
+    :return: path of the proxy
+    """
+    path = preview_path(content_digest(video_path), height, previews_folder)
+    with _locks_lock:
+        lock = _locks.setdefault(str(path), threading.Lock())
+    with lock:
+        if path.exists():
+            return str(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # ffmpeg picks the format from the extension, keep .mp4 at the end
+        temporary_path = path.with_name(f'.{path.stem}.tmp.mp4')
+        command = ['ffmpeg', '-y', '-i', video_path, '-vf', f'scale=-2:{height}', '-c:v', 'libx264',
+                   '-preset', 'veryfast', '-crf', str(crf), '-c:a', 'aac', '-b:a', audio_bitrate,
+                   '-movflags', '+faststart', str(temporary_path)]
+        logging.info(f"process {' '.join(command)}")
+        services.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        os.replace(temporary_path, path)
+    return str(path)
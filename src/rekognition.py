@@ -4,18 +4,33 @@
 # Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # PDX-License-Identifier: MIT-0 (For details, see https://github.com/awsdocs/amazon-rekognition-developer-guide/blob/master/LICENSE-SAMPLECODE.)
 
+import itertools
 import json
+import logging
 import sys
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from pathlib import Path
 
 import boto3
+import numpy as np
+
+MAX_RESULTS = 1000
+UNCLAIMED_TTL = 3600
+MAX_UNCLAIMED = 1000
+CACHE_FOLDER = 'artifacts/rekognition'
+LABEL_LENGTH = 64
+
+_BOUNDING_BOX = [('left', 'f4'), ('top', 'f4'), ('width', 'f4'), ('height', 'f4')]
+FACE_DTYPE = np.dtype([('timestamp', 'i8'), *_BOUNDING_BOX, ('confidence', 'f4')])
+PERSON_DTYPE = np.dtype([('timestamp', 'i8'), ('index', 'i4'), *_BOUNDING_BOX, ('confidence', 'f4')])
+LABEL_DTYPE = np.dtype([('timestamp', 'i8'), ('name', f'U{LABEL_LENGTH}'), *_BOUNDING_BOX, ('confidence', 'f4')])
 
 
 class VideoDetect:
     jobId = ''
-    rek = boto3.client('rekognition')
-    sqs = boto3.client('sqs')
-    sns = boto3.client('sns')
 
     roleArn = ''
     bucket = ''
@@ -26,10 +41,13 @@ class VideoDetect:
     snsTopicArn = ''
     processType = ''
 
-    def __init__(self, role, bucket, video):
+    def __init__(self, role, bucket, video, rek=None, sqs=None, sns=None):
         self.roleArn = role
         self.bucket = bucket
         self.video = video
+        self.rek = rek or boto3.client('rekognition')
+        self.sqs = sqs or boto3.client('sqs')
+        self.sns = sns or boto3.client('sns')
 
     def GetSQSMessageSuccess(self):
 
@@ -83,6 +101,7 @@ class VideoDetect:
 
         self.startJobId = response['JobId']
         print('Start Job Id: ' + self.startJobId)
+        return self.startJobId
 
     def GetLabelDetectionResults(self):
         maxResults = 10
@@ -122,24 +141,28 @@ class VideoDetect:
                     print("      " + parent['Name'])
                 print()
 
-                if 'NextToken' in response:
-                    paginationToken = response['NextToken']
-                else:
-                    finished = True
+            if 'NextToken' in response:
+                paginationToken = response['NextToken']
+            else:
+                finished = True
 
-    def CreateTopicandQueue(self):
+    def CreateTopicandQueue(self, name=None):
+        """
+        Create the SNS topic and the SQS queue for the job notifications.
+        With a name they are shared: creating them again with the same name returns the existing ones.
+        """
 
-        millis = str(int(round(time.time() * 1000)))
+        suffix = name or str(int(round(time.time() * 1000)))
 
         # Create SNS topic
 
-        snsTopicName = "AmazonRekognitionExample" + millis
+        snsTopicName = "AmazonRekognitionExample" + suffix
 
         topicResponse = self.sns.create_topic(Name=snsTopicName)
         self.snsTopicArn = topicResponse['TopicArn']
 
         # create SQS queue
-        sqsQueueName = "AmazonRekognitionQueue" + millis
+        sqsQueueName = "AmazonRekognitionQueue" + suffix
         self.sqs.create_queue(QueueName=sqsQueueName)
         self.sqsQueueUrl = self.sqs.get_queue_url(QueueName=sqsQueueName)['QueueUrl']
 
@@ -179,6 +202,12 @@ class VideoDetect:
                 'Policy': policy
             })
 
+    def Dispatcher(self, wait_time_seconds=20):
+        """
+        Dispatcher of the completion notifications of this topic and queue, shared by all the jobs using them
+        """
+        return CompletionDispatcher(self.sqs, self.sqsQueueUrl, wait_time_seconds)
+
     def DeleteTopicandQueue(self):
         self.sqs.delete_queue(QueueUrl=self.sqsQueueUrl)
         self.sns.delete_topic(TopicArn=self.snsTopicArn)
@@ -192,6 +221,7 @@ class VideoDetect:
 
         self.startJobId = response['JobId']
         print('Start Job Id: ' + self.startJobId)
+        return self.startJobId
 
     def StartFaceDetection(self):
         response = self.rek.start_face_detection(Video={'S3Object': {'Bucket': self.bucket, 'Name': self.video}},
@@ -201,6 +231,7 @@ class VideoDetect:
 
         self.startJobId = response['JobId']
         print('Start Job Id: ' + self.startJobId)
+        return self.startJobId
 
     def GetPersonTracking(self):
         maxResults = 10
@@ -230,7 +261,6 @@ class VideoDetect:
                 paginationToken = response['NextToken']
             else:
                 finished = True
-            finished = True
 
     def GetFaceDetectionResults(self):
         maxResults = 10
@@ -259,7 +289,282 @@ class VideoDetect:
                 paginationToken = response['NextToken']
             else:
                 finished = True
-            finished = True
+
+    # ============== Collectors ===============
+    def _collect(self, job_id, kind, get_page, key, to_rows, dtype, cache_folder):
+        """
+        Read every result page of the job into a structured array cached on disk by JobId.
+        Only the results of a SUCCEEDED job are read and cached.
+        :raises RuntimeError: if the job is still running or failed
+        """
+        cache_path = Path(cache_folder) / f'{kind}-{job_id}.npy'
+        if cache_path.exists():
+            return np.load(cache_path)
+        rows = []
+        metadata = None
+        paginationToken = ''
+        while True:
+            kwargs = {'JobId': job_id, 'MaxResults': MAX_RESULTS}
+            if paginationToken:
+                kwargs['NextToken'] = paginationToken
+            response = get_page(**kwargs)
+            status = response.get('JobStatus')
+            if status != 'SUCCEEDED':
+                raise RuntimeError(f'Rekognition job {job_id} is {status}: '
+                                   f'{response.get("StatusMessage", "no results to collect")}')
+            metadata = metadata or response.get('VideoMetadata')
+            for detection in response[key]:
+                rows.extend(to_rows(detection))
+            if 'NextToken' not in response:
+                break
+            paginationToken = response['NextToken']
+        result = np.array(rows, dtype=dtype)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # the metadata first: the array is the cache entry, it must not exist without its metadata
+        with open(cache_path.with_suffix('.json'), 'w') as f:
+            json.dump(metadata or {}, f)
+        np.save(cache_path, result)
+        return result
+
+    def CollectFaceDetections(self, job_id, cache_folder=CACHE_FOLDER):
+        def to_rows(faceDetection):
+            face = faceDetection['Face']
+            yield (faceDetection['Timestamp'], *_bounding_box(face), face['Confidence'])
+
+        return self._collect(job_id, 'faces', self.rek.get_face_detection, 'Faces', to_rows, FACE_DTYPE,
+                             cache_folder)
+
+    def CollectPersonTracking(self, job_id, cache_folder=CACHE_FOLDER):
+        def to_rows(personDetection):
+            person = personDetection['Person']
+            confidence = person['Face']['Confidence'] if 'Face' in person else np.nan
+            yield (personDetection['Timestamp'], person['Index'], *_bounding_box(person), confidence)
+
+        return self._collect(job_id, 'persons', self.rek.get_person_tracking, 'Persons', to_rows, PERSON_DTYPE,
+                             cache_folder)
+
+    def CollectLabelDetections(self, job_id, cache_folder=CACHE_FOLDER):
+        def to_rows(labelDetection):
+            label = labelDetection['Label']
+            instances = label['Instances'] or [{'Confidence': label['Confidence']}]
+            for instance in instances:
+                yield (labelDetection['Timestamp'], label['Name'][:LABEL_LENGTH], *_bounding_box(instance),
+                       instance['Confidence'])
+
+        return self._collect(job_id, 'labels', self.rek.get_label_detection, 'Labels', to_rows, LABEL_DTYPE,
+                             cache_folder)
+
+
+class CompletionDispatcher:
+    """
+    Long-poll one shared SQS queue and route the Rekognition completion notifications
+    to futures keyed by JobId, so any number of jobs can wait on the same topic and queue.
+
+    The dispatcher owns the queue: every message is deleted once read. Notifications of jobs
+    that are not registered yet are kept until the job is registered, for unclaimed_ttl seconds
+    and at most max_unclaimed of them, the oldest are dropped first.
+    """
+
+    def __init__(self, sqs, queue_url: str, wait_time_seconds: int = 20, unclaimed_ttl: float = UNCLAIMED_TTL,
+                 max_unclaimed: int = MAX_UNCLAIMED):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.wait_time_seconds = wait_time_seconds
+        self.unclaimed_ttl = unclaimed_ttl
+        self.max_unclaimed = max_unclaimed
+        self._futures: dict[str, Future] = {}
+        # JobId -> (monotonic time of arrival, notification), oldest first
+        self._unclaimed: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, job_id: str) -> Future:
+        """
+        Future resolved with the completion notification of the job ({'JobId', 'Status', ...})
+        :param job_id:
+        :return:
+        """
+        with self._lock:
+            future = self._futures.get(job_id)
+            if future is None:
+                future = Future()
+                self._futures[job_id] = future
+                if job_id in self._unclaimed:
+                    future.set_result(self._unclaimed.pop(job_id)[1])
+        return future
+
+    def pending(self) -> list[str]:
+        with self._lock:
+            return [job_id for job_id, future in self._futures.items() if not future.done()]
+
+    def unclaimed(self) -> list[str]:
+        with self._lock:
+            return list(self._unclaimed)
+
+    def poll(self, wait_time_seconds: int = None) -> int:
+        """
+        Receive one batch of messages and dispatch it
+        :param wait_time_seconds: long poll duration, wait_time_seconds of the dispatcher if not set
+        :return: number of messages received
+        """
+        if wait_time_seconds is None:
+            wait_time_seconds = self.wait_time_seconds
+        response = self.sqs.receive_message(QueueUrl=self.queue_url, MessageAttributeNames=['ALL'],
+                                            MaxNumberOfMessages=10, WaitTimeSeconds=wait_time_seconds)
+        messages = response.get('Messages', [])
+        for message in messages:
+            try:
+                notification = json.loads(message['Body'])
+                rekMessage = json.loads(notification['Message'])
+            except (KeyError, ValueError):
+                logging.warning(f'Skipping unexpected message {message.get("MessageId")}')
+                continue
+            self._dispatch(rekMessage)
+        if messages:
+            self.sqs.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in
+                         enumerate(messages)])
+        return len(messages)
+
+    def _dispatch(self, rekMessage: dict):
+        job_id = rekMessage['JobId']
+        with self._lock:
+            future = self._futures.get(job_id)
+            if future is None:
+                self._unclaimed[job_id] = (time.monotonic(), rekMessage)
+                self._unclaimed.move_to_end(job_id)
+                self._expire_unclaimed()
+                return
+        if not future.done():
+            future.set_result(rekMessage)
+
+    def _expire_unclaimed(self):
+        expired = time.monotonic() - self.unclaimed_ttl
+        while self._unclaimed:
+            job_id, (received, _) = next(iter(self._unclaimed.items()))
+            if received >= expired and len(self._unclaimed) <= self.max_unclaimed:
+                break
+            del self._unclaimed[job_id]
+            logging.warning(f'Dropping the notification of job {job_id}, no one registered it')
+
+    def run_until_complete(self, job_ids=None, timeout: float = None):
+        """
+        Poll in the calling thread until the given (by default all registered) jobs are complete
+        :param job_ids:
+        :param timeout: seconds
+        :return: completion notifications by JobId
+        """
+        futures = {job_id: self.register(job_id) for job_id in (job_ids or list(self._futures))}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not all(future.done() for future in futures.values()):
+            if deadline is None:
+                self.poll()
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'Jobs {[job_id for job_id, f in futures.items() if not f.done()]} are not complete')
+            # the long poll never outlasts the deadline
+            self.poll(min(self.wait_time_seconds, int(remaining)))
+        return {job_id: future.result() for job_id, future in futures.items()}
+
+    def start(self):
+        """
+        Poll in a background thread until stop() is called
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='rekognition-dispatcher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error(f'Polling {self.queue_url} failed: {e}')
+                self._stop.wait(5)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class InMemoryQueue:
+    """
+    Local stand-in for the SQS client used by CompletionDispatcher
+    """
+
+    def __init__(self):
+        self._messages = deque()
+        self._in_flight = {}
+        self._condition = threading.Condition()
+        self._receipts = itertools.count()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        with self._condition:
+            self._messages.append(MessageBody)
+            self._condition.notify_all()
+        return {'MessageId': str(len(self._messages))}
+
+    def publish_completion(self, job_id: str, status: str = 'SUCCEEDED', api: str = 'StartLabelDetection'):
+        """
+        Send a message shaped like a Rekognition notification delivered by SNS
+        """
+        message = json.dumps({'JobId': job_id, 'Status': status, 'API': api})
+        self.send_message('', json.dumps({'Type': 'Notification', 'Message': message}))
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        with self._condition:
+            self._condition.wait_for(lambda: self._messages, timeout=WaitTimeSeconds)
+            messages = []
+            while self._messages and len(messages) < MaxNumberOfMessages:
+                receipt = str(next(self._receipts))
+                body = self._messages.popleft()
+                self._in_flight[receipt] = body
+                messages.append({'MessageId': receipt, 'ReceiptHandle': receipt, 'Body': body})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self._condition:
+            for entry in Entries:
+                self._in_flight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def __len__(self):
+        return len(self._messages) + len(self._in_flight)
+
+
+def _bounding_box(detection: dict) -> tuple:
+    box = detection.get('BoundingBox')
+    if not box:
+        return np.nan, np.nan, np.nan, np.nan
+    return box['Left'], box['Top'], box['Width'], box['Height']
+
+
+def load_video_metadata(kind: str, job_id: str, cache_folder=CACHE_FOLDER) -> dict:
+    with open(Path(cache_folder) / f'{kind}-{job_id}.json', 'r') as f:
+        return json.load(f)
+
+
+def showed_frames(detections: np.ndarray, frame_rate: float, key: str = 'index') -> dict:
+    """
+    Convert collected detections to frame numbers per person (or label), the same form
+    faces.utils.Person.showed_frames uses for the local face analysis
+    :param detections: structured array from one of the VideoDetect.Collect* methods
+    :param frame_rate: frame rate from the video metadata
+    :param key: field to group the detections by, e.g. 'index' for persons or 'name' for labels
+    :return:
+    """
+    frames = np.rint(detections['timestamp'] / 1000 * frame_rate).astype(np.int64)
+    result = {}
+    for value in np.unique(detections[key]):
+        result[value.item()] = np.unique(frames[detections[key] == value]).tolist()
+    return result
 
 
 def main():
@@ -274,8 +579,9 @@ def main():
     # if analyzer.GetSQSMessageSuccess() == True:
     # analyzer.startJobId = 'b97cba9b48ce2713f18d0c0e9a675c3ab6dd2e272fb39557409a32b77ca4bb13'
     # analyzer.startJobId = '8bc83d526a08d63f75e2a2f57327c6d14c3b57201ecbbfb974af0073b006d371'
-    analyzer.startJobId = '7322bf5f4663c2c7c5b19f4ff3881dd86f8ac3799aa41d409f32e685a613acba'
-    analyzer.GetPersonTracking()
+    job_id = '7322bf5f4663c2c7c5b19f4ff3881dd86f8ac3799aa41d409f32e685a613acba'
+    persons = analyzer.CollectPersonTracking(job_id)
+    print(f'{len(persons)} person detections, {len(np.unique(persons["index"]))} persons')
 
     # analyzer.DeleteTopicandQueue()
 
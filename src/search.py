@@ -0,0 +1,272 @@
+"""
+Full-text search over the source and translated segments of all the processed videos.
+
+The index is a sqlite database with an FTS5 table over the segments; every segment keeps its video,
+language, speaker and timings, so a hit points straight into the video. Videos are indexed one at
+a time from their bundles (see bundle.py) as they finish; re-indexing a language of a video replaces
+its segments in that language:
+
+    python search.py index data/results/*.tta
+    python search.py search "declaración del testigo" --language=es-ES
+"""
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from glob import glob
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+from fire import Fire
+
+from bundle import Bundle
+from dto import Item
+from instrumentation import count, span
+from subtitles.export import timestamp_parts
+
+INDEX_PATH = 'data/search.sqlite3'
+# matches ranked per query; for very common words only the most recently indexed ones are ranked
+MAX_CANDIDATES = 2000
+_WORD = re.compile(r'\w+')
+
+
+class Hit(NamedTuple):
+    video_id: str
+    video_path: str
+    language: str
+    segment: int
+    speaker_label: str
+    start_time: float
+    end_time: float
+    content: str
+    # content with the matched words in **bold**
+    snippet: str
+
+
+def fts_query(text: str, phrase: bool = False, language: str = None, video_id: str = None) -> str:
+    """
+    FTS5 query matching all the words of the text (or the exact phrase) in the content; the last word
+    is a prefix so the query works while it is typed. The filters are columns of the full-text index too,
+    so they narrow the posting lists instead of being checked row by row.
+    """
+    words = _WORD.findall(text)
+    if not words:
+        return ''
+    if phrase:
+        query = '"' + ' '.join(words) + '"'
+    else:
+        query = ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+    query = f'content : ({query})'
+    if language is not None:
+        query += f' AND language : "{language}"'
+    if video_id is not None:
+        query += f' AND video_id : "{video_id}"'
+    return query
+
+
+def _fold(word: str) -> str:
+    """
+    Word as compared by the index tokenizer: case and diacritics removed
+    """
+    decomposed = unicodedata.normalize('NFKD', word)
+    return ''.join(character for character in decomposed if not unicodedata.combining(character)).casefold()
+
+
+def highlight(content: str, text: str) -> str:
+    """
+    Content with the words of the query in **bold**, the last query word matching as a prefix
+    """
+    words = [_fold(word) for word in _WORD.findall(text)]
+    if not words:
+        return content
+    exact, prefix = set(words[:-1]), words[-1]
+
+    def replace(match):
+        word = _fold(match.group(0))
+        return f'**{match.group(0)}**' if word in exact or word.startswith(prefix) else match.group(0)
+
+    return _WORD.sub(replace, content)
+
+
+def video_id_for(video_path: Union[str, Path]) -> str:
+    """
+    Id of a video in the index: the file stem, which is the content hash for the uploaded videos
+    """
+    return Path(video_path).stem.split('.')[0]
+
+
+class SearchIndex:
+
+    def __init__(self, path: str = INDEX_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS videos (
+                    video_id TEXT PRIMARY KEY,
+                    video_path TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS bundles (
+                    path TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS segments (
+                    id INTEGER PRIMARY KEY,
+                    video_id TEXT NOT NULL,
+                    language TEXT NOT NULL,
+                    segment INTEGER NOT NULL,
+                    speaker_label TEXT,
+                    start_time REAL,
+                    end_time REAL,
+                    content TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS segments_video ON segments (video_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(
+                    content, video_id, language,
+                    content='segments', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TRIGGER IF NOT EXISTS segments_insert AFTER INSERT ON segments BEGIN
+                    INSERT INTO segments_fts (rowid, content, video_id, language)
+                    VALUES (new.id, new.content, new.video_id, new.language);
+                END;
+                CREATE TRIGGER IF NOT EXISTS segments_delete AFTER DELETE ON segments BEGIN
+                    INSERT INTO segments_fts (segments_fts, rowid, content, video_id, language)
+                    VALUES ('delete', old.id, old.content, old.video_id, old.language);
+                END;''')
+
+    def index_video(self, video_id: str, video_path: str, segments: dict[str, list[Item]]):
+        """
+        Index the segments of a video, replacing the ones indexed before in the same languages
+        :param video_id:
+        :param video_path: video the hits are played from
+        :param segments: items by language, source and translations
+        """
+        rows = [(video_id, language, index, item.speaker_label, item.start_time, item.end_time, item.content())
+                for language, items in segments.items() for index, item in enumerate(items)]
+        with self._lock, self._connection, span('search.index_video'):
+            self._connection.executemany('DELETE FROM segments WHERE video_id = ? AND language = ?',
+                                         [(video_id, language) for language in segments])
+            self._connection.executemany(
+                'INSERT INTO segments (video_id, language, segment, speaker_label, start_time, end_time, content) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._connection.execute('INSERT OR REPLACE INTO videos VALUES (?, ?)', (video_id, video_path))
+        count('search.indexed_segments', len(rows))
+
+    def is_indexed(self, path: Union[str, Path], fingerprint: str) -> bool:
+        with self._lock:
+            row = self._connection.execute('SELECT fingerprint FROM bundles WHERE path = ?', (str(path),)).fetchone()
+        return row is not None and row[0] == fingerprint
+
+    def index_bundle(self, path: Union[str, Path], video_id: str = None) -> bool:
+        """
+        Index the source and translated segments of a bundle unless this version is indexed already
+        :param path: bundle file
+        :param video_id: the id derived from the video path of the bundle if not set; the results of
+            several target languages of one video are separate bundles sharing the video id
+        :return: True if the bundle was (re)indexed
+        """
+        stat = os.stat(path)
+        fingerprint = f'{stat.st_size}-{stat.st_mtime_ns}'
+        if self.is_indexed(path, fingerprint):
+            return False
+        with Bundle(path) as bundle:
+            source_video_path = bundle.metadata.get('source_video_path', bundle.metadata['video_path'])
+            video_id = video_id or video_id_for(source_video_path)
+            source_language = bundle.metadata.get('source_language', 'source')
+            segments = {source_language: bundle.items('segments')}
+            for table in bundle.tables('translations/'):
+                segments[table.split('/', 1)[1]] = bundle.items(table)
+            self.index_video(video_id, bundle.metadata['video_path'], segments)
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO bundles VALUES (?, ?)', (str(path), fingerprint))
+        return True
+
+    def remove_video(self, video_id: str):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM segments WHERE video_id = ?', (video_id,))
+            self._connection.execute('DELETE FROM videos WHERE video_id = ?', (video_id,))
+
+    def search(self, text: str, limit: int = 20, language: str = None, video_id: str = None,
+               phrase: bool = False, max_candidates: int = MAX_CANDIDATES) -> list[Hit]:
+        """
+        Segments matching all the words of the text, best matches first
+        :param text:
+        :param limit:
+        :param language: only segments in this language, e.g. 'en-US'
+        :param video_id: only segments of this video
+        :param phrase: match the words as an exact phrase
+        :param max_candidates: matches ranked at most, the most recently indexed ones
+        :return:
+        """
+        query = fts_query(text, phrase, language, video_id)
+        if not query:
+            return []
+        with self._lock, span('search.query'):
+            # ranking is done on a bounded number of matches, so common words stay fast
+            candidates = self._connection.execute(
+                'SELECT rowid, bm25(segments_fts, 1.0, 0.0, 0.0) FROM segments_fts WHERE segments_fts MATCH ? '
+                'ORDER BY rowid DESC LIMIT ?', (query, max_candidates)).fetchall()
+            best = [rowid for rowid, _ in sorted(candidates, key=lambda candidate: candidate[1])[:limit]]
+            rows = self._connection.execute(
+                'SELECT segments.id, segments.video_id, videos.video_path, segments.language, segments.segment, '
+                'segments.speaker_label, segments.start_time, segments.end_time, segments.content '
+                'FROM segments JOIN videos ON videos.video_id = segments.video_id '
+                f'WHERE segments.id IN ({",".join("?" * len(best))})', best).fetchall()
+        count('search.queries')
+        by_id = {row[0]: row[1:] for row in rows}
+        return [Hit(*by_id[rowid], highlight(by_id[rowid][-1], text)) for rowid in best if rowid in by_id]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+def format_hit(hit: Hit) -> str:
+    clock, _ = timestamp_parts(hit.start_time or 0.0)
+    return f'{hit.video_id} {clock} [{hit.language}] {hit.speaker_label}: {hit.snippet}'
+
+
+def index(*paths: str, index_path: str = INDEX_PATH):
+    """
+    Index bundles, globs are expanded
+    """
+    search_index = SearchIndex(index_path)
+    indexed = 0
+    for pattern in paths:
+        for path in sorted(glob(pattern)) or [pattern]:
+            indexed += search_index.index_bundle(path)
+    print(f'Indexed {indexed} videos, {len(search_index)} segments in the index')
+
+
+def search(text: str, limit: int = 20, language: str = None, phrase: bool = False, index_path: str = INDEX_PATH):
+    for hit in SearchIndex(index_path).search(text, limit, language, phrase=phrase):
+        print(format_hit(hit))
+
+
+_index: Optional[SearchIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> SearchIndex:
+    """
+    The index shared by the threads of the process
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SearchIndex()
+        return _index
+
+
+if __name__ == '__main__':
+    Fire({
+        'index': index,
+        'search': search,
+    })
@@ -0,0 +1,72 @@
+"""
+Single access point to the external services: AWS clients, transcript downloads, ffmpeg runs and
+the waits between status polls.
+
+By default everything goes to boto3, requests, subprocess and time. `use` swaps in another backend
+for the whole process, e.g. the simulated services of loadtest.fake_aws:
+
+    with services.use(FakeAWS()):
+        process('video.mp4')
+"""
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import boto3
+import requests
+
+_backend = None
+_lock = threading.Lock()
+
+
+def client(service_name: str, **kwargs):
+    """
+    boto3.client or the client of the backend in use
+    """
+    if _backend is not None:
+        return _backend.client(service_name, **kwargs)
+    return boto3.client(service_name, **kwargs)
+
+
+def fetch_json(url: str):
+    """
+    Download a json document, e.g. a transcript from its TranscriptFileUri
+    """
+    if _backend is not None:
+        return _backend.fetch_json(url)
+    return requests.get(url).json()
+
+
+def run(command: list[str], **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run of an external tool (ffmpeg)
+    """
+    if _backend is not None:
+        return _backend.run(command, **kwargs)
+    return subprocess.run(command, **kwargs)
+
+
+def sleep(seconds: float):
+    """
+    Wait on a remote service: between the polls of a job or before retrying a throttled call
+    """
+    if _backend is not None:
+        return _backend.sleep(seconds)
+    time.sleep(seconds)
+
+
+@contextmanager
+def use(backend):
+    """
+    Route all the service calls of the process to backend while in the block
+    :param backend: object with client, fetch_json, run and sleep methods
+    """
+    global _backend
+    with _lock:
+        previous, _backend = _backend, backend
+    try:
+        yield backend
+    finally:
+        with _lock:
+            _backend = previous
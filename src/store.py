@@ -0,0 +1,125 @@
+"""
+Content addressed storage of the uploaded videos and of the pipeline results.
+
+Uploads are stored once under the sha256 of their content, the results of the pipeline are
+stored by the same hash (and language pair) so every session reopening the video gets them.
+Results are bundles (see bundle.py); results pickled by older versions are still read.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+from bundle import Bundle, BundleWriter, SUFFIX
+
+CHUNK_SIZE = 8 * 1024 * 1024
+VIDEOS_FOLDER = 'data/videos'
+RESULTS_FOLDER = 'data/results'
+# mkstemp creates files only the owner can read; the stored files get the mode open() gives instead,
+# so ffmpeg or a web server running as another user can read them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+def file_digest(fileobj: BinaryIO, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    sha256 of a file object, read in chunks from the beginning
+    :param fileobj:
+    :param chunk_size:
+    :return:
+    """
+    hash_object = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        hash_object.update(chunk)
+    fileobj.seek(0)
+    return hash_object.hexdigest()
+
+
+def path_digest(file_path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    with open(file_path, 'rb') as f:
+        return file_digest(f, chunk_size)
+
+
+def atomic_write(path: Path, write):
+    """
+    Write to a temporary file in the same folder and move it in place,
+    so concurrent sessions never see a partially written file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            os.fchmod(f.fileno(), FILE_MODE)
+            write(f)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def video_path(digest: str, suffix: str = '.mp4', videos_folder: str = VIDEOS_FOLDER) -> Path:
+    """
+    The file name is the digest too: it is used as S3 key and Transcribe job name
+    """
+    return Path(videos_folder) / digest / f'{digest}{suffix}'
+
+
+def store_upload(fileobj: BinaryIO, file_name: str, videos_folder: str = VIDEOS_FOLDER) -> Tuple[str, str]:
+    """
+    Store the uploaded file once by its content hash
+    :param fileobj:
+    :param file_name: original file name, only its suffix is kept
+    :param videos_folder:
+    :return: digest and path of the stored video
+    """
+    digest = file_digest(fileobj)
+    path = video_path(digest, Path(file_name).suffix, videos_folder)
+    if not path.exists():
+        atomic_write(path, lambda f: shutil.copyfileobj(fileobj, f, CHUNK_SIZE))
+        fileobj.seek(0)
+    return digest, str(path)
+
+
+def _results_path(digest: str, source_language: str, target_language: str, results_folder: str,
+                  suffix: str = SUFFIX) -> Path:
+    return Path(results_folder) / f'{digest}-{source_language}-{target_language}{suffix}'
+
+
+def load_results(digest: str, source_language: str, target_language: str,
+                 results_folder: str = RESULTS_FOLDER) -> Optional[dict]:
+    """
+    :return: output video path, source and translated items; None if the video was not processed
+    """
+    path = _results_path(digest, source_language, target_language, results_folder)
+    if path.exists():
+        with Bundle(path) as bundle:
+            return {'video_path': bundle.metadata['video_path'], 'source_items': bundle.items('segments'),
+                    'translated_items': bundle.items(f'translations/{target_language}')}
+    legacy_path = _results_path(digest, source_language, target_language, results_folder, '.pickle')
+    if legacy_path.exists():
+        with open(legacy_path, 'rb') as f:
+            return pickle.load(f)
+    return None
+
+
+def save_results(digest: str, source_language: str, target_language: str, results: dict,
+                 results_folder: str = RESULTS_FOLDER) -> Path:
+    """
+    :param results: output video path ('video_path'), source and translated items,
+        optionally the Transcribe response ('transcript') for the speaker turns
+    :return: path of the results bundle
+    """
+    writer = BundleWriter({'video_path': results['video_path'], 'source_language': source_language,
+                           'target_languages': [target_language]})
+    writer.add_items('segments', results['source_items'])
+    writer.add_items(f'translations/{target_language}', results['translated_items'])
+    if results.get('transcript') is not None:
+        writer.add_speaker_turns(results['transcript'])
+    path = _results_path(digest, source_language, target_language, results_folder)
+    atomic_write(path, writer.write)
+    return path
@@ -1,13 +1,20 @@
+import copy
 import os
+import time
 from pathlib import Path
 
 import streamlit as st
-from joblib import Parallel, delayed
 
 from dto import Item
-from subtitles.subtitles import create_subtitle, create_subtitles_file, write_srt_to_file
-from transcribe.amazon import transcribe
-from translate.translate import translate_item
+from fileserver import file_url, get_file_server, publish
+from instrumentation import traced
+from jobs import DONE, FAILED, STAGES, get_queue, preview_job_id, read_job, video_job_id
+from preview import cached_preview
+from search import Hit, get_index
+from store import load_results, save_results, store_upload
+from subtitles.export import timestamp_parts
+from subtitles.subtitles import create_subtitles_file, write_srt_to_file
+from translate.translate import TranslationError, translate_items
 
 os.environ['AWS_ACCESS_KEY_ID'] = st.secrets['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY'] = st.secrets['AWS_SECRET_ACCESS_KEY']
@@ -15,42 +22,7 @@ os.environ['AWS_REGION'] = 'us-east-1'
 os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
 
 
-# @st.cache(suppress_st_warning=True)
-def process_video(parent_component, video_path: str, source_language='es-ES', target_language: str = 'en-US'):
-    progress_bar = st.progress(0)
-    step = 100 // 6
-    transcription = transcribe_video_step(parent_component, source_language, video_path)
-    progress_bar.progress(1 * step)
-    grouped_items = create_subtitles_step(parent_component, transcription, video_path)
-    progress_bar.progress(2 * step)
-    create_subtitles_file_step(parent_component, video_path, grouped_items)
-    progress_bar.progress(3 * step)
-    translated_items = translate_items_step(parent_component, grouped_items, source_language, target_language)
-    progress_bar.progress(4 * step)
-    subtitles_file_path = create_subtitles_file_step(parent_component, video_path, translated_items)
-    progress_bar.progress(5 * step)
-    output_path = burn_subtitles_to_video_step(parent_component, video_path, subtitles_file_path)
-    progress_bar.progress(6 * step)
-    progress_bar.empty()
-    return output_path, grouped_items, translated_items
-
-
-def transcribe_video_step(parent_component, source_language, video_path):
-    message = parent_component.info('Transcribing the video...')
-    transcription = transcribe(video_path, language=source_language)
-    message.empty()
-    return transcription
-
-
-def create_subtitles_step(parent_component, transcription, video_path):
-    message = parent_component.info('creating subtitles...')
-    grouped_items: list[Item] = create_subtitle(transcription)
-    subtitles_file_path = Path(video_path).with_suffix('.srt')
-    create_subtitles_file(str(subtitles_file_path), grouped_items)
-    message.empty()
-    return grouped_items
-
-
+@traced()
 def burn_subtitles_to_video_step(parent_component, video_path, subtitles_file_path):
     message = parent_component.info('Writing subtitles to video...')
     output_path = str(Path(video_path).with_suffix('.en.mp4'))
@@ -59,14 +31,22 @@ def burn_subtitles_to_video_step(parent_component, video_path, subtitles_file_pa
     return output_path
 
 
-def translate_items_step(parent_component, grouped_items, source_language, target_language):
+@traced()
+def translate_items_step(parent_component, grouped_items, source_language, target_language, segment_ids=None):
     message = parent_component.info('Translating subtitles...')
-    translated_items: list[Item] = Parallel(n_jobs=15)(
-        delayed(translate_item)(item, source_language, target_language) for item in grouped_items)
+    try:
+        translated_items: list[Item] = translate_items(grouped_items, source_language, target_language)
+    except TranslationError as e:
+        message.empty()
+        failed = sorted(segment_ids[index] if segment_ids else index for index in e.failed_segments)
+        parent_component.error(f'Translation failed for segments {", ".join(map(str, failed))}, '
+                               f'process the video again to retry them.')
+        st.stop()
     message.empty()
     return translated_items
 
 
+@traced()
 def create_subtitles_file_step(parent_component, video_path: str, translated_items: list[Item], suffix='.en.srt'):
     message = parent_component.info('Creating subtitles file...')
     subtitles_file_path = Path(video_path).with_suffix(suffix)
@@ -79,101 +59,242 @@ def main_app():
     st.title('Transcribe, Translate and Analyze')
 
     source_language = language_component()
+    target_language = 'en-US'
 
-    is_valid, video_path = file_uploader_component(st.sidebar)
+    is_valid, video_path, digest = file_uploader_component(st.sidebar)
     video_container = st.container()
     col1, col3 = st.columns(2)
     info = st.container()
     text_container = st.container()
+    search_component(st.sidebar, video_container)
 
     if is_valid:
-        st.session_state.video_path = video_path
-        if 'source_texts' in st.session_state:
+        if st.session_state.get('digest') != (digest, source_language):
+            open_video(digest, video_path, source_language, target_language)
+        if 'source_items' in st.session_state:
             reprocess_video_button = col1.button('Process Video')
             if reprocess_video_button:
                 with info:
                     with st.spinner(text='Re-process Video'):
-                        source_items, translated_items, video_path = reprocess(
-                            info, st.session_state.video_path,
+                        source_items, translated_items, output_path = reprocess(
+                            info, video_path,
                             st.session_state.source_items,
-                            st.session_state.source_texts,
+                            st.session_state.source_edits,
                             st.session_state.translated_items,
-                            st.session_state.translated_texts,
+                            st.session_state.translated_edits,
                             source_language
                         )
-                        st.session_state.video_path = video_path
-                        st.session_state.source_items = source_items
-                        st.session_state.translated_items = translated_items
+                        if output_path is not None:
+                            save_processed_video(digest, source_language, target_language, output_path,
+                                                 source_items, translated_items)
         else:
-            process_video_button = col1.button('Process Video')
+            job_id = video_job_id(digest, source_language, target_language)
+            job = read_job(job_id)
+            is_active = job is not None and job['status'] not in (DONE, FAILED)
+            process_video_button = col1.button('Process Video', disabled=is_active)
             if process_video_button:
+                get_queue().submit_video(digest, video_path, source_language, target_language)
+                job = read_job(job_id)
+            if job is not None:
                 with info:
-                    with st.spinner(text='Preparing Video'):
-                        video_path, source_items, translated_items = process_video(info, video_path, source_language)
-                        st.session_state.video_path = video_path
-                        st.session_state.source_items = source_items
-                        st.session_state.translated_items = translated_items
+                    job_progress_component(job, digest, source_language, target_language)
 
         if 'video_path' in st.session_state:
-            with open(st.session_state.video_path, 'rb') as f:
-                col3.download_button('Download video', f, file_name='output.mp4')
-        if 'video_path' in st.session_state:
-            video_container.video(st.session_state.video_path)
+            download_component(col3, st.session_state.video_path)
+            with video_container:
+                show_video(st.session_state.video_path)
         if 'source_items' in st.session_state:
-            st.session_state.source_texts, st.session_state.translated_texts = set_content(
-                text_container, st.session_state.source_items,
-                st.session_state.translated_items,
-            )
-
-
-def set_content(text_container, source_items, translated_items):
+            set_content(text_container, st.session_state.source_items, st.session_state.translated_items)
+
+
+def download_component(parent_component, video_path: str, file_name: str = 'output.mp4'):
+    """
+    Link to the video on the file server; without it the video is loaded into Streamlit only when asked for
+    """
+    path = publish(video_path) if get_file_server() is not None else None
+    if path is not None:
+        parent_component.markdown(f'[Download video]({file_url(str(path), file_name)})')
+    elif parent_component.button('Prepare the download'):
+        with open(video_path, 'rb') as f:
+            parent_component.download_button('Download video', f, file_name=file_name)
+
+
+def show_video(video_path: str, start_time: int = 0):
+    """
+    Play the low bitrate preview of the video; a job worker encodes it, a placeholder is shown until then
+    """
+    path = cached_preview(video_path)
+    if path is None:
+        job = read_job(preview_job_id(video_path))
+        if job is not None and job['status'] == FAILED:
+            st.warning(f'The preview could not be created: {job.get("error")}')
+            return
+        get_queue().submit_preview(video_path)
+        st.info('The preview of the video is being prepared, it plays here once it is ready.')
+        return
+    # the file server streams the preview with range requests; without it streamlit serves the file
+    st.video(file_url(path) if get_file_server() is not None else path, start_time=start_time)
+
+
+def search_component(parent_component, results_container, limit: int = 20):
+    """
+    Search the segments of all the processed videos; a hit plays its video from the segment start
+    """
+    text = parent_component.text_input('Search the videos')
+    if not text:
+        return
+    hits = get_index().search(text, limit=limit)
+    if not hits:
+        parent_component.info('No segments found')
+        return
+    for index, hit in enumerate(hits):
+        clock, _ = timestamp_parts(hit.start_time or 0.0)
+        if parent_component.button(f'{clock} {hit.speaker_label or ""} [{hit.language}]', key=f'search-hit-{index}'):
+            st.session_state.search_hit = hit
+        parent_component.markdown(hit.snippet)
+    hit: Hit = st.session_state.get('search_hit')
+    if hit is not None:
+        with results_container:
+            st.caption(f'{hit.video_id}, {hit.speaker_label or ""}: {hit.content}')
+            show_video(hit.video_path, start_time=int(hit.start_time or 0))
+
+
+def job_progress_component(job: dict, digest: str, source_language: str, target_language: str,
+                           poll_interval: float = 2.0):
+    """
+    Show the stage of a background job and rerun the script until it is complete
+    """
+    if job['status'] == FAILED:
+        st.error(f'Processing failed: {job.get("error")}')
+        return
+    if job['status'] == DONE:
+        results = load_results(digest, source_language, target_language)
+        if results is not None and 'source_items' not in st.session_state:
+            for key, value in results.items():
+                st.session_state[key] = value
+            reset_edits()
+            st.experimental_rerun()
+        return
+    st.progress(job['progress'])
+    stage = job['stage'] or 'waiting for a free worker'
+    st.info(f'Processing the video: {stage} ({STAGES.index(stage) + 1 if stage in STAGES else 0}/{len(STAGES)})')
+    time.sleep(poll_interval)
+    st.experimental_rerun()
+
+
+def open_video(digest: str, video_path: str, source_language: str, target_language: str):
+    """
+    Reset the session to a newly uploaded video, with its results if any session processed it before
+    """
+    for key in ('source_items', 'translated_items'):
+        if key in st.session_state:
+            del st.session_state[key]
+    reset_edits()
+    st.session_state.digest = (digest, source_language)
+    st.session_state.video_path = video_path
+    results = load_results(digest, source_language, target_language)
+    if results is not None:
+        for key, value in results.items():
+            st.session_state[key] = value
+
+
+def save_processed_video(digest: str, source_language: str, target_language: str, output_path: str,
+                         source_items: list[Item], translated_items: list[Item]):
+    results = {'video_path': output_path, 'source_items': source_items, 'translated_items': translated_items}
+    get_index().index_bundle(save_results(digest, source_language, target_language, results))
+    for key, value in results.items():
+        st.session_state[key] = value
+    reset_edits()
+
+
+def reset_edits():
+    """
+    Forget the recorded edits; the new widget keys drop the widget state of the previous items
+    """
+    st.session_state.source_edits = {}
+    st.session_state.translated_edits = {}
+    st.session_state.editor_version = st.session_state.get('editor_version', 0) + 1
+
+
+def record_edit(edits_key: str, segment_id: int, widget_key: str):
+    st.session_state[edits_key][segment_id] = st.session_state[widget_key]
+
+
+def segment_text_area(column, edits_key: str, item: Item, segment_id: int):
+    widget_key = f'{edits_key}-{st.session_state.editor_version}-{segment_id}'
+    column.text_area(
+        label=f'#{segment_id} {item.speaker_label}',
+        value=st.session_state[edits_key].get(segment_id, item.content()),
+        key=widget_key,
+        on_change=record_edit,
+        args=(edits_key, segment_id, widget_key),
+    )
+
+
+def set_content(text_container, source_items, translated_items, page_sizes=(25, 50, 100)):
+    """
+    Render only one page of segments; edits are recorded by segment id in the session state
+    so they survive page switches and only the changed segments are processed again
+    """
     with text_container:
+        pagination_column, page_size_column, edits_column = st.columns(3)
+        page_size = page_size_column.selectbox('Segments per page', page_sizes)
+        pages = max((len(source_items) + page_size - 1) // page_size, 1)
+        page = pagination_column.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1, step=1)
+        changed = len(st.session_state.source_edits.keys() | st.session_state.translated_edits.keys())
+        edits_column.metric('Edited segments', changed)
+
         source_column, translated_column = st.columns(2)
-        source_texts = []
-        translated_texts = []
-        for item in source_items:
-            source_texts.append(
-                source_column.text_area(label=f'{item.speaker_label}', value=item.content(), on_change=None)
-            )
-        for item in translated_items:
-            translated_texts.append(
-                translated_column.text_area(label=f'{item.speaker_label}', value=item.content(), on_change=None)
-            )
-        return source_texts, translated_texts
-
-
-def update_source_items(source_items: list[Item], source_text: list[str]):
-    if len(source_text) == 0:
-        return False
-    assert len(source_items) == len(source_text), 'source_items and source_text must have the same length'
-    is_updated = False
-    for i, item in enumerate(source_items):
-        if item.content() != source_text[i]:
-            print('item has been changed to ', source_text[i])
-            print('item was', item.content())
-            item._content = source_text[i]
-            print('item become', item.content())
-            is_updated = True
-    return is_updated, source_items
-
-
-def reprocess(parent_component, video_path: str, source_items: list[Item],
-              source_texts: list[str],
-              translated_items: list[Item], translated_text: list[str], source_language='es-ES',
+        start = (int(page) - 1) * page_size
+        for segment_id in range(start, min(start + page_size, len(source_items))):
+            segment_text_area(source_column, 'source_edits', source_items[segment_id], segment_id)
+            segment_text_area(translated_column, 'translated_edits', translated_items[segment_id], segment_id)
+
+
+def apply_edits(items: list[Item], edits: dict[int, str]) -> set[int]:
+    """
+    Replace the edited items in the list by copies with the edited texts, the items themselves are not changed
+    :param items:
+    :param edits: text by segment id
+    :return: ids of the segments whose text changed
+    """
+    changed = set()
+    for segment_id, text in edits.items():
+        if items[segment_id].content() != text:
+            items[segment_id] = copy.copy(items[segment_id])
+            items[segment_id]._content = text
+            changed.add(segment_id)
+    return changed
+
+
+@traced()
+def reprocess(parent_component, video_path: str, source_items: list[Item], source_edits: dict[int, str],
+              translated_items: list[Item], translated_edits: dict[int, str], source_language='es-ES',
               target_language: str = 'en-US'):
+    """
+    Translate again only the edited source segments, apply the edited translations and rewrite the video.
+    The items of the session are left as they are: if a step fails, the edits are still pending on the next run.
+    :return: source items, translated items and the output path (None if nothing changed)
+    """
     progress_bar = st.progress(0)
     step = 100 // 4
-    is_changed, source_items = update_source_items(source_items, source_texts)
+    source_items = list(source_items)
+    translated_items = list(translated_items)
+    changed_source = apply_edits(source_items, source_edits)
     progress_bar.progress(1 * step)
-    if is_changed:
-        translated_items = translate_items_step(parent_component, source_items, source_language, target_language)
-        progress_bar.progress(2 * step)
-    else:
-        is_updates, translated_items = update_source_items(translated_items, translated_text)
-        if is_updates:
-            parent_component.info('Nothing changed')
-            progress_bar.empty()
-            return True
+    if changed_source:
+        changed_ids = sorted(changed_source)
+        retranslated = translate_items_step(parent_component, [source_items[i] for i in changed_ids],
+                                            source_language, target_language, changed_ids)
+        for segment_id, item in zip(changed_ids, retranslated):
+            translated_items[segment_id] = item
+    # explicit edits of the translation win over the new translation of the same segment
+    changed_translations = apply_edits(translated_items, translated_edits)
+    progress_bar.progress(2 * step)
+    if not changed_source and not changed_translations:
+        parent_component.info('Nothing changed')
+        progress_bar.empty()
+        return source_items, translated_items, None
     subtitles_file_path = create_subtitles_file_step(parent_component, video_path, translated_items)
     progress_bar.progress(3 * step)
     output_path = burn_subtitles_to_video_step(parent_component, video_path, subtitles_file_path)
@@ -191,19 +312,21 @@ def language_component():
 
 
 def file_uploader_component(parent_component):
+    """
+    Store the uploaded video once by its content hash; reruns reuse the stored file
+    :param parent_component:
+    :return: is_valid, video path and content hash
+    """
     uploaded_file = parent_component.file_uploader("Video", type=['mp4'])
-    video_path = None
-    if uploaded_file is not None:
-        is_valid = True
+    if uploaded_file is None:
+        return False, None, None
+    upload_key = getattr(uploaded_file, 'id', None) or (uploaded_file.name, uploaded_file.size)
+    if st.session_state.get('upload_key') != upload_key:
         with st.spinner(text='Uploading...'):
-            Path(os.path.join("data", "videos")).mkdir(parents=True, exist_ok=True)
-
-            with open(os.path.join("data", "videos", uploaded_file.name), "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            video_path = f'data/videos/{uploaded_file.name}'
-    else:
-        is_valid = False
-    return is_valid, video_path
+            st.session_state.upload = store_upload(uploaded_file, uploaded_file.name)
+            st.session_state.upload_key = upload_key
+    digest, video_path = st.session_state.upload
+    return True, video_path, digest
 
 
 if __name__ == '__main__':
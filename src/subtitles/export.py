@@ -0,0 +1,116 @@
+"""
+Single pass export of segments to SRT, WebVTT, Markdown and JSON Lines.
+
+The segments are read once (any iterable, so a generator works too) and every format is written
+through its own buffered file, so the export cost stays linear in the number of segments.
+The files appear complete or not at all.
+"""
+import json
+import os
+import tempfile
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Iterable, Union
+
+from dto import Item
+from store import FILE_MODE
+
+FORMATS = ('srt', 'vtt', 'md', 'jsonl')
+SUFFIXES = {'srt': '.srt', 'vtt': '.vtt', 'md': '.md', 'jsonl': '.jsonl'}
+BUFFER_SIZE = 1024 * 1024
+
+
+def timestamp_parts(time: float) -> tuple[str, int]:
+    """
+    'hh:mm:ss' and milliseconds of a time in seconds, rounded to the millisecond
+    """
+    milliseconds = int(time * 1000 + 0.5)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02}:{minutes:02}:{seconds:02}', milliseconds
+
+
+def export_paths(base_path: Union[str, Path], formats: Iterable[str] = FORMATS) -> dict[str, str]:
+    """
+    Paths of the formats next to base_path, e.g. video.en.srt, video.en.vtt for 'video.en'
+    """
+    return {file_format: str(base_path) + SUFFIXES[file_format] for file_format in formats}
+
+
+def _write(segments: Iterable[Item], files: dict) -> int:
+    srt = files.get('srt')
+    vtt = files.get('vtt')
+    markdown = files.get('md')
+    jsonl = files.get('jsonl')
+    if vtt is not None:
+        vtt.write('WEBVTT\n\n')
+
+    index = 0
+    for index, item in enumerate(segments, start=1):
+        content = item.content()
+        if srt is not None or vtt is not None:
+            start, start_ms = timestamp_parts(item.start_time)
+            end, end_ms = timestamp_parts(item.end_time)
+            if srt is not None:
+                srt.write(f'{index}\n{start},{start_ms:03} --> {end},{end_ms:03}\n'
+                          f'{item.speaker_label}: {content}\n\n')
+            if vtt is not None:
+                vtt.write(f'{index}\n{start}.{start_ms:03} --> {end}.{end_ms:03}\n'
+                          f'<v {item.speaker_label}>{content}\n\n')
+        if markdown is not None:
+            markdown.write(f'{item.speaker_label}: {content}\n\n')
+        if jsonl is not None:
+            jsonl.write(json.dumps({'id': index - 1, 'start_time': item.start_time, 'end_time': item.end_time,
+                                    'speaker_label': item.speaker_label, 'content': content},
+                                   ensure_ascii=False))
+            jsonl.write('\n')
+    return index
+
+
+def export(segments: Iterable[Item], paths: dict[str, Union[str, Path]], buffer_size: int = BUFFER_SIZE) -> int:
+    """
+    Write the segments to all the requested formats in one pass. Every format is written to a temporary
+    file that is moved in place once all the segments are written, so an export interrupted by an error
+    in the segments (e.g. a failed translation of a stream) leaves no partial file behind.
+    :param segments:
+    :param paths: output path by format, formats from FORMATS
+    :param buffer_size:
+    :return: number of segments written
+    """
+    unknown = set(paths) - set(FORMATS)
+    if unknown:
+        raise ValueError(f'Unknown export formats {unknown}, expected some of {FORMATS}')
+    temporary_paths = {}
+    try:
+        with ExitStack() as stack:
+            files = {}
+            for file_format, path in paths.items():
+                path = Path(path)
+                descriptor, temporary_paths[file_format] = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+                files[file_format] = stack.enter_context(open(descriptor, 'w', encoding='utf-8',
+                                                              buffering=buffer_size))
+                os.fchmod(descriptor, FILE_MODE)
+            count = _write(segments, files)
+        for file_format, temporary_path in temporary_paths.items():
+            os.replace(temporary_path, paths[file_format])
+    except BaseException:
+        for temporary_path in temporary_paths.values():
+            if os.path.exists(temporary_path):
+                os.unlink(temporary_path)
+        raise
+    return count
+
+
+def read_jsonl(file_path: Union[str, Path]) -> list[Item]:
+    """
+    Read the items back from a JSON Lines export
+    """
+    items = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            item = Item(row['speaker_label'], row['start_time'], row['end_time'])
+            item._content = row['content']
+            items.append(item)
+    return items
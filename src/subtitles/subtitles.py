@@ -1,13 +1,15 @@
 import logging
 import subprocess
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 
-import boto3
 from fire import Fire
 from tqdm import tqdm
 
+import services
 from dto import AWSItem, SpeakerLabel, Item
+from instrumentation import traced
+from subtitles.export import export, timestamp_parts
 from transcribe.amazon import transcribe
 
 
@@ -35,77 +37,124 @@ def group_items_by_speaker(items: [AWSItem]) -> [AWSItem]:
     return result
 
 
+@traced('ffmpeg.burn_subtitles')
 def write_srt_to_file(video_path: str, subtitles_path: str, output_path: str):
     command = ['ffmpeg', '-y', '-i', video_path, '-max_muxing_queue_size', '9999', '-vf', f'subtitles={subtitles_path}',
                output_path]
     logging.info(f"process {' '.join(command)}")
-    result = subprocess.run(command, stdout=subprocess.PIPE)
+    result = services.run(command, stdout=subprocess.PIPE)
+    logging.debug(result.stdout)
+
+
+ISO_639_2 = {
+    'ar': 'ara', 'de': 'deu', 'en': 'eng', 'es': 'spa', 'fr': 'fra', 'he': 'heb', 'hi': 'hin', 'it': 'ita',
+    'ja': 'jpn', 'ko': 'kor', 'nl': 'nld', 'pl': 'pol', 'pt': 'por', 'ru': 'rus', 'tr': 'tur', 'uk': 'ukr',
+    'zh': 'zho',
+}
+
+
+@traced('ffmpeg.mux_subtitles')
+def mux_subtitle_tracks(video_path: str, subtitles_paths: dict[str, str], output_path: str):
+    """
+    Add one soft subtitle track per language in a single ffmpeg pass; audio and video are copied, not encoded
+    :param video_path:
+    :param subtitles_paths: srt path by language code, e.g. {'en-US': 'video.en.srt'}
+    :param output_path: mp4 file
+    :return:
+    """
+    command = ['ffmpeg', '-y', '-i', video_path]
+    for subtitles_path in subtitles_paths.values():
+        command += ['-i', str(subtitles_path)]
+    command += ['-map', '0:v', '-map', '0:a?']
+    for index in range(len(subtitles_paths)):
+        command += ['-map', str(index + 1)]
+    command += ['-c:v', 'copy', '-c:a', 'copy', '-c:s', 'mov_text']
+    for index, language in enumerate(subtitles_paths):
+        iso_language = ISO_639_2.get(language.split('-')[0].lower(), 'und')
+        command += [f'-metadata:s:s:{index}', f'language={iso_language}', f'-metadata:s:s:{index}', f'title={language}']
+    command += [output_path]
+    logging.info(f"process {' '.join(command)}")
+    result = services.run(command, stdout=subprocess.PIPE)
     logging.debug(result.stdout)
 
 
 def format_time_for_subtitles(time: float) -> str:
     '00:00:01,840'
     'hh:mm:ss,ms'
-    hours = int(time / 3600)
-    minutes = int((time - hours * 3600) / 60)
-    seconds = int(time - hours * 3600 - minutes * 60)
-    milliseconds = int((time - hours * 3600 - minutes * 60 - seconds) * 1000)
-    return f'{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}'
+    clock, milliseconds = timestamp_parts(time)
+    return f'{clock},{milliseconds:03}'
 
 
+@traced()
 def create_subtitles_file(file_path: str, grouped_items: [AWSItem]):
     print(f'Creating subtitles file {file_path}')
-    with open(file_path, 'w') as f:
-        for index, item in enumerate(tqdm(grouped_items)):
-            f.write(f'{index}\n')
-            f.write(f'{format_time_for_subtitles(item.start_time)} --> {format_time_for_subtitles(item.end_time)}\n')
-            f.write(f'{item.speaker_label}: {item.content()}\n\n')
+    export(grouped_items, {'srt': file_path})
 
 
-def create_subtitle(response) -> List[Item]:
+def _segment(grouped_item: AWSItem) -> Item:
+    item = Item(
+        start_time=grouped_item.start_time,
+        end_time=grouped_item.end_time,
+        speaker_label=grouped_item.speaker_label
+    )
+    item._content = grouped_item.content()
+    return item
+
+
+def iter_subtitles(response) -> Iterator[Item]:
     """
-    Create a subtitle file from the response of the Transcribe API
+    Segments of the response of the Transcribe API, grouped as in group_items_by_speaker.
+    A segment is yielded as soon as the next one starts, so the translation and the export of the first
+    segments do not wait for the whole transcript; only the segment being built is kept.
     :param response:
     :return:
     """
-    items_dict = {}
-    items = []
-    for item in tqdm(response['results']['items']):
+    speakers = {}
+    for segment in response['results']['speaker_labels']['segments']:
         try:
-            i = AWSItem(**item)
-            items_dict[i.start_time] = i
-            items.append(i)
+            speaker_label = SpeakerLabel(**segment)
         except Exception as e:
-            print(e, item)
-            assert e
+            print(e, segment)
+            continue
+        for item in speaker_label.items:
+            speakers[item.start_time] = speaker_label.speaker_label
 
-    speaker_labels = []
-    for speaker_label in tqdm(response['results']['speaker_labels']['segments']):
+    current = None
+    for entry in tqdm(response['results']['items']):
         try:
-            speaker_labels.append(SpeakerLabel(**speaker_label))
+            item = AWSItem(**entry)
         except Exception as e:
-            print(e, speaker_label)
-            assert e
+            print(e, entry)
+            continue
+        if item.start_time is not None:
+            item.speaker_label = speakers.get(item.start_time)
+        if current is not None and item.start_time is None:
+            current.alternatives.extend(item.alternatives)
+            continue
+        if current is not None and current.speaker_label == item.speaker_label \
+                and item.start_time - current.start_time < 5:
+            current.alternatives.extend(item.alternatives)
+            current.end_time = item.end_time
+            continue
+        if current is not None:
+            yield _segment(current)
+        current = item
+    if current is not None:
+        yield _segment(current)
 
-    for speaker_label in speaker_labels:
-        for item in speaker_label.items:
-            items_dict[item.start_time].speaker_label = speaker_label.speaker_label
-    grouped_items = group_items_by_speaker(items)
-    result_items = []
-    for grouped_item in grouped_items:
-        item = Item(
-            start_time=grouped_item.start_time,
-            end_time=grouped_item.end_time,
-            speaker_label=grouped_item.speaker_label
-        )
-        item._content = grouped_item.content()
-        result_items.append(item)
 
-    return result_items
+@traced()
+def create_subtitle(response) -> List[Item]:
+    """
+    Create a subtitle file from the response of the Transcribe API
+    :param response:
+    :return:
+    """
+    return list(iter_subtitles(response))
 
 
 def upload_file_to_s3(file_path: str, bucket_name: str, s3_key: str):
-    s3 = boto3.client('s3')
+    s3 = services.client('s3')
     s3.upload_file(file_path, bucket_name, s3_key)
     return f's3://{bucket_name}/{s3_key}'
 
@@ -12,22 +12,23 @@ Amazon Transcribe Developer Guide here:
 """
 import json
 import logging
-import time
 from pathlib import Path
 from typing import Optional
 
-import boto3
-import requests
 from fire import Fire
 from tqdm import tqdm
 
+import services
+from instrumentation import count, span, traced
 from utils import upload_file_to_s3
 
 
-def transcribe_file(job_name, file_uri, language='es-ES', output_folder='subtitles/'):
-    transcribe_client = boto3.client('transcribe')
+def transcribe_file(job_name, file_uri, language='es-ES', output_folder='subtitles/', max_wait_seconds=1800,
+                    poll_interval=10):
+    transcribe_client = services.client('transcribe')
     job = check_the_job(job_name)
     if job is None:
+        count('aws.api_calls')
         job = transcribe_client.start_transcription_job(
             TranscriptionJobName=job_name,
             Media={'MediaFileUri': file_uri},
@@ -40,10 +41,11 @@ def transcribe_file(job_name, file_uri, language='es-ES', output_folder='subtitl
                 # 'MaxAlternatives': 123,
             },
         )
-    max_tries = 180
+    max_tries = max(int(max_wait_seconds / poll_interval), 1)
     pbar = tqdm(total=max_tries)
     while max_tries > 0:
         max_tries -= 1
+        count('aws.api_calls')
         job = transcribe_client.get_transcription_job(TranscriptionJobName=job_name)
         job_status = job['TranscriptionJob']['TranscriptionJobStatus']
         pbar.set_description(f'{job_name} status: {job_status}')
@@ -54,20 +56,21 @@ def transcribe_file(job_name, file_uri, language='es-ES', output_folder='subtitl
                 logging.debug(
                     f"Download the transcript from\n"
                     f"\t{job['TranscriptionJob']['Transcript']['TranscriptFileUri']}.")
-                response = requests.get(job['TranscriptionJob']['Transcript']['TranscriptFileUri'])
+                with span('aws.transcribe.download'):
+                    result = services.fetch_json(job['TranscriptionJob']['Transcript']['TranscriptFileUri'])
                 with open(f'{output_folder}/{job_name}.json', 'w') as f:
-                    result = response.json()
                     json.dump(result, f)
                 return result
             return None
         # else:
         # print(f"Waiting for {job_name}. Current status is {job_status}.")
-        time.sleep(10)
+        services.sleep(poll_interval)
 
 
 def check_the_job(job_name: str) -> Optional[dict]:
-    transcribe_client = boto3.client('transcribe')
+    transcribe_client = services.client('transcribe')
     try:
+        count('aws.api_calls')
         job = transcribe_client.get_transcription_job(TranscriptionJobName=job_name)
         job = job['TranscriptionJob']
         if job['TranscriptionJobStatus'] == 'FAILED':
@@ -81,14 +84,16 @@ def check_the_job(job_name: str) -> Optional[dict]:
     return None
 
 
-def transcribe(file_uri: str, language='es-ES', subtitles_folder='./artifacts/subtitles/') -> Optional[dict]:
+@traced('transcribe')
+def transcribe(file_uri: str, language='es-ES', subtitles_folder='./artifacts/subtitles/',
+               max_wait_seconds=1800) -> Optional[dict]:
     project_name = Path(file_uri).name
     Path(subtitles_folder).mkdir(parents=True, exist_ok=True)
     if not file_uri.startswith('s3://'):
         s3_uri = upload_file_to_s3(file_uri)
     else:
         s3_uri = file_uri
-    return transcribe_file(project_name, s3_uri, language, subtitles_folder)
+    return transcribe_file(project_name, s3_uri, language, subtitles_folder, max_wait_seconds)
 
 
 def transcribe_cli(file_uri: str):
@@ -0,0 +1,268 @@
+"""
+Chunked transcription of long media.
+
+The audio is split at silences into overlapping chunks that are transcribed as concurrent jobs,
+so the time to transcript is bounded by the longest chunk instead of the whole recording.
+The chunk transcripts are stitched back into one response shaped like the Transcribe output:
+
+- timings are shifted by the chunk offset;
+- every chunk keeps only the items starting between its cut points, which drops the words
+  transcribed twice in the overlaps;
+- speaker labels are made global by matching the words both chunks transcribed in an overlap.
+"""
+import json
+import logging
+import re
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from fire import Fire
+
+from instrumentation import traced
+from transcribe.amazon import transcribe
+
+SILENCE_START = re.compile(r'silence_start: (-?[\d.]+)')
+SILENCE_END = re.compile(r'silence_end: ([\d.]+)')
+
+
+class Chunk(NamedTuple):
+    index: int
+    # part of the media in the chunk file
+    start: float
+    end: float
+    # items starting in [keep_start, keep_end) belong to this chunk
+    keep_start: float
+    keep_end: float
+
+
+def media_duration(file_path: str) -> float:
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
+               'default=noprint_wrappers=1:nokey=1', file_path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+    return float(result.stdout.decode().strip())
+
+
+def detect_silences(file_path: str, noise: str = '-30dB', min_silence: float = 0.5) -> list[tuple[float, float]]:
+    """
+    Silent intervals of the audio found by the ffmpeg silencedetect filter
+    :param file_path:
+    :param noise: level under which the audio counts as silence
+    :param min_silence: minimal duration of a silence in seconds
+    :return:
+    """
+    command = ['ffmpeg', '-hide_banner', '-nostats', '-i', file_path, '-vn', '-af',
+               f'silencedetect=noise={noise}:d={min_silence}', '-f', 'null', '-']
+    result = subprocess.run(command, stderr=subprocess.PIPE)
+    silences = []
+    start = None
+    for line in result.stderr.decode(errors='replace').splitlines():
+        match = SILENCE_START.search(line)
+        if match:
+            start = max(float(match.group(1)), 0.0)
+            continue
+        match = SILENCE_END.search(line)
+        if match and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    return silences
+
+
+def plan_chunks(duration: float, silences: list[tuple[float, float]], chunk_seconds: float = 600,
+                overlap: float = 5.0, search_seconds: float = 60) -> list[Chunk]:
+    """
+    Cut the media about every chunk_seconds, at the middle of the silence closest to the target
+    :param duration:
+    :param silences:
+    :param chunk_seconds:
+    :param overlap: seconds added on both sides of every cut
+    :param search_seconds: how far from the target a silence is looked for
+    :return:
+    """
+    middles = sorted((start + end) / 2 for start, end in silences)
+    cuts = [0.0]
+    while duration - cuts[-1] > chunk_seconds * 1.25:
+        target = cuts[-1] + chunk_seconds
+        candidates = [middle for middle in middles
+                      if abs(middle - target) <= search_seconds and middle > cuts[-1] + 2 * overlap]
+        cuts.append(min(candidates, key=lambda middle: abs(middle - target)) if candidates else target)
+    cuts.append(duration)
+    chunks = []
+    for index, (cut_start, cut_end) in enumerate(zip(cuts, cuts[1:])):
+        keep_end = cut_end if index < len(cuts) - 2 else float('inf')
+        chunks.append(Chunk(index, max(cut_start - overlap, 0.0), min(cut_end + overlap, duration),
+                            cut_start, keep_end))
+    return chunks
+
+
+def chunk_path(file_path: str, chunk: Chunk) -> str:
+    return str(Path(file_path).with_suffix(f'.part{chunk.index:03}-{int(chunk.start)}-{int(chunk.end)}.mp4'))
+
+
+def extract_chunk(file_path: str, chunk: Chunk) -> str:
+    """
+    Copy the audio of the chunk to its own mp4 file, without encoding
+    """
+    output_path = chunk_path(file_path, chunk)
+    if not Path(output_path).exists():
+        command = ['ffmpeg', '-y', '-ss', f'{chunk.start:.3f}', '-i', file_path, '-t', f'{chunk.end - chunk.start:.3f}',
+                   '-vn', '-c:a', 'copy', output_path]
+        logging.info(f"process {' '.join(command)}")
+        subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return output_path
+
+
+def _chunk_items(response: dict, offset: float) -> list[dict]:
+    """
+    Items of a chunk transcript with media timings and their (chunk local) speaker label
+    """
+    speakers = {}
+    for segment in response['results'].get('speaker_labels', {}).get('segments', []):
+        for item in segment['items']:
+            speakers[item['start_time']] = item['speaker_label']
+    items = []
+    for item in response['results']['items']:
+        row = {'type': item['type'], 'alternatives': item['alternatives']}
+        if 'start_time' in item:
+            row['start'] = float(item['start_time']) + offset
+            row['end'] = float(item['end_time']) + offset
+            row['speaker'] = item.get('speaker_label') or speakers.get(item['start_time'])
+        items.append(row)
+    return items
+
+
+def _speaker_votes(previous: list[dict], items: list[dict], start: float, end: float,
+                   tolerance: float = 0.3) -> Counter:
+    """
+    Count how often a chunk label and a global label were given to the same word of the overlap
+    """
+    previous = [row for row in previous if 'start' in row and start <= row['start'] <= end and row['speaker']]
+    votes = Counter()
+    for row in items:
+        if 'start' not in row or not (start <= row['start'] <= end) or not row['speaker'] or not previous:
+            continue
+        closest = min(previous, key=lambda other: abs(other['start'] - row['start']))
+        if abs(closest['start'] - row['start']) <= tolerance:
+            votes[(row['speaker'], closest['speaker'])] += 1
+    return votes
+
+
+def _speaker_mapping(votes: Counter, items: list[dict], labels: Counter) -> dict[str, str]:
+    mapping = {}
+    used = set()
+    for (label, global_label), _ in votes.most_common():
+        if label not in mapping and global_label not in used:
+            mapping[label] = global_label
+            used.add(global_label)
+    for row in items:
+        label = row.get('speaker')
+        if label and label not in mapping:
+            mapping[label] = f'spk_{len(labels)}'
+            labels[mapping[label]] += 1
+    return mapping
+
+
+def _response(items: list[dict]) -> dict:
+    """
+    Transcribe shaped response from the stitched items
+    """
+    result_items = []
+    segments = []
+    transcript = []
+    for row in items:
+        item = {'type': row['type'], 'alternatives': row['alternatives']}
+        content = row['alternatives'][0]['content'] if row['alternatives'] else ''
+        if 'start' not in row:
+            transcript.append(content)
+            result_items.append(item)
+            continue
+        transcript.append(f' {content}' if transcript else content)
+        item['start_time'] = f'{row["start"]:.3f}'
+        item['end_time'] = f'{row["end"]:.3f}'
+        if row['speaker']:
+            item['speaker_label'] = row['speaker']
+            timing = {'start_time': item['start_time'], 'end_time': item['end_time'], 'speaker_label': row['speaker']}
+            if segments and segments[-1]['speaker_label'] == row['speaker']:
+                segments[-1]['end_time'] = item['end_time']
+                segments[-1]['items'].append(timing)
+            else:
+                segments.append({**timing, 'items': [timing]})
+        result_items.append(item)
+    return {
+        'results': {
+            'transcripts': [{'transcript': ''.join(transcript)}],
+            'speaker_labels': {'speakers': len({segment['speaker_label'] for segment in segments}),
+                               'segments': segments},
+            'items': result_items,
+        },
+        'status': 'COMPLETED',
+    }
+
+
+def stitch(responses: list[dict], chunks: list[Chunk]) -> dict:
+    """
+    Stitch the chunk transcripts into one Transcribe shaped response
+    :param responses: transcript of every chunk, in the order of the chunks
+    :param chunks:
+    :return:
+    """
+    stitched = []
+    labels = Counter()
+    previous = None
+    previous_chunk = None
+    for response, chunk in zip(responses, chunks):
+        items = _chunk_items(response, chunk.start)
+        votes = Counter()
+        if previous is not None:
+            votes = _speaker_votes(previous, items, chunk.start, previous_chunk.end)
+        mapping = _speaker_mapping(votes, items, labels)
+        for row in items:
+            if row.get('speaker'):
+                row['speaker'] = mapping[row['speaker']]
+
+        keep = False
+        for row in items:
+            if 'start' in row:
+                keep = chunk.keep_start <= row['start'] < chunk.keep_end
+            if keep:
+                stitched.append(row)
+        previous = items
+        previous_chunk = chunk
+    return _response(stitched)
+
+
+@traced('transcribe_chunked')
+def transcribe_chunked(file_path: str, language='es-ES', chunk_seconds: float = 600, overlap: float = 5.0,
+                       subtitles_folder='./artifacts/subtitles/', max_wait_seconds=3600) -> Optional[dict]:
+    """
+    Transcribe a long recording as concurrent jobs over overlapping chunks
+    :param file_path: local media file
+    :param language:
+    :param chunk_seconds: target chunk duration
+    :param overlap: seconds shared by consecutive chunks
+    :param subtitles_folder:
+    :param max_wait_seconds: how long to wait for every chunk job
+    :return: stitched transcript, shaped like the Transcribe response
+    """
+    duration = media_duration(file_path)
+    if duration <= chunk_seconds * 1.25:
+        return transcribe(file_path, language, subtitles_folder, max_wait_seconds)
+    chunks = plan_chunks(duration, detect_silences(file_path), chunk_seconds, overlap)
+    logging.info(f'Transcribing {file_path} in {len(chunks)} chunks')
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        paths = list(executor.map(lambda chunk: extract_chunk(file_path, chunk), chunks))
+        responses = list(executor.map(lambda path: transcribe(path, language, subtitles_folder, max_wait_seconds),
+                                      paths))
+    failed = [chunk.index for chunk, response in zip(chunks, responses) if response is None]
+    if failed:
+        raise RuntimeError(f'Transcription of chunks {failed} of {file_path} failed')
+    result = stitch(responses, chunks)
+    with open(Path(subtitles_folder) / f'{Path(file_path).name}.json', 'w') as f:
+        json.dump(result, f)
+    return result
+
+
+if __name__ == '__main__':
+    Fire(transcribe_chunked)
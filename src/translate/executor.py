@@ -0,0 +1,142 @@
+"""
+Thread based executor for the I/O bound Translate API calls.
+
+The number of requests in flight follows AIMD: it grows by one every `limit` successful calls
+and is halved on a throttling response. Throttled and transient failures are retried with
+full-jitter exponential backoff; results keep the order of the inputs.
+"""
+import logging
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Sequence
+
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+import services
+from instrumentation import count, gauge
+
+THROTTLING_ERRORS = {
+    'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'LimitExceededException',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded', 'SlowDown',
+}
+TRANSIENT_ERRORS = {'ServiceUnavailableException', 'InternalServerException', 'InternalFailure', 'RequestTimeout'}
+
+
+def error_code(error: Exception) -> str:
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code', '')
+    return ''
+
+
+def is_throttling(error: Exception) -> bool:
+    return error_code(error) in THROTTLING_ERRORS
+
+
+def is_retryable(error: Exception) -> bool:
+    # botocore network errors (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError...) do not
+    # derive from the builtin ConnectionError, and botocore does not retry them with max_attempts=1
+    return (is_throttling(error) or error_code(error) in TRANSIENT_ERRORS
+            or isinstance(error, (ConnectionError, BotocoreConnectionError, HTTPClientError)))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of concurrent calls
+    """
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 32, decrease: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class TaskFailed(Exception):
+    """
+    Some tasks failed after all the retries; `failed` holds the error by task index
+    """
+
+    def __init__(self, failed: dict[int, Exception], results: list):
+        self.failed = failed
+        self.results = results
+        indexes = ', '.join(str(index) for index in sorted(failed)[:20])
+        more = '' if len(failed) <= 20 else f' and {len(failed) - 20} more'
+        super().__init__(f'{len(failed)} of {len(results)} tasks failed: {indexes}{more}')
+
+
+class AdaptiveExecutor:
+
+    def __init__(self, initial_concurrency: int = 4, max_concurrency: int = 32, max_retries: int = 6,
+                 base_delay: float = 0.25, max_delay: float = 20.0):
+        self.limiter = AdaptiveLimiter(initial_concurrency, maximum=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _call(self, function: Callable, args: tuple):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                result = function(*args)
+            except Exception as e:
+                throttled = is_throttling(e)
+                self.limiter.release(throttled=throttled)
+                if throttled:
+                    count('aws.throttled')
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logging.debug(f'Retrying in {delay:.2f}s after {e}')
+                attempt += 1
+                count('aws.retries')
+                services.sleep(delay)
+                continue
+            self.limiter.release()
+            return result
+
+    def submit(self, pool: ThreadPoolExecutor, function: Callable, args: tuple) -> Future:
+        """
+        Call function in the pool under the adaptive limit, with the retries
+        """
+        return pool.submit(self._call, function, args)
+
+    def map(self, function: Callable, arguments: Sequence[tuple]) -> list:
+        """
+        Call function with every tuple of arguments
+        :param function:
+        :param arguments:
+        :return: results in the order of the arguments
+        :raises TaskFailed: with the partial results if any call failed
+        """
+        results = [None] * len(arguments)
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [executor.submit(self._call, function, args) for args in arguments]
+            for index, future in enumerate(futures):
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    failed[index] = e
+        gauge('translate.concurrency_limit', self.limiter.limit)
+        if failed:
+            raise TaskFailed(failed, results)
+        return results
@@ -0,0 +1,125 @@
+"""
+Translation memory shared by all the videos.
+
+Translations are keyed by the source text and the language pair (timings and speakers do not matter),
+so repeated sentences - the oath, procedural formulas - are sent to the Translate API only once.
+The memory is a sqlite database: lookups are done in bulk and it can be shared by processes.
+"""
+import re
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+MEMORY_PATH = 'cache/translation_memory.sqlite3'
+_BATCH_SIZE = 500
+
+
+def normalize(text: str) -> str:
+    """
+    Normalized form of a text for the fuzzy lookup: unicode NFKC, case folded, single spaces
+    """
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip().casefold()
+
+
+def _batches(values: list, size: int = _BATCH_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class TranslationMemory:
+
+    def __init__(self, path: str = MEMORY_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS translations (
+                    source_language TEXT NOT NULL,
+                    target_language TEXT NOT NULL,
+                    source_text TEXT NOT NULL,
+                    normalized_text TEXT NOT NULL,
+                    translated_text TEXT NOT NULL,
+                    PRIMARY KEY (source_language, target_language, source_text)
+                )''')
+            self._connection.execute('''
+                CREATE INDEX IF NOT EXISTS translations_normalized
+                ON translations (source_language, target_language, normalized_text)''')
+        self.hits = 0
+        self.normalized_hits = 0
+        self.misses = 0
+
+    def _select(self, column: str, values: list, source_language: str, target_language: str) -> dict:
+        result = {}
+        with self._lock:
+            for batch in _batches(values):
+                rows = self._connection.execute(
+                    f'SELECT {column}, translated_text FROM translations '
+                    f'WHERE source_language = ? AND target_language = ? AND {column} IN ({",".join("?" * len(batch))})',
+                    [source_language, target_language, *batch])
+                result.update(rows)
+        return result
+
+    def lookup_many(self, texts: Iterable[str], source_language: str, target_language: str) -> dict[str, str]:
+        """
+        Find the known translations, by exact text first and by normalized text for the rest
+        :param texts:
+        :param source_language:
+        :param target_language:
+        :return: translation by source text, only for the texts found
+        """
+        texts = list(dict.fromkeys(texts))
+        found = self._select('source_text', texts, source_language, target_language)
+        self.hits += len(found)
+        missing = [text for text in texts if text not in found]
+        if missing:
+            normalized = self._select('normalized_text', list({normalize(text) for text in missing}),
+                                      source_language, target_language)
+            for text in missing:
+                translation = normalized.get(normalize(text))
+                if translation is not None:
+                    found[text] = translation
+                    self.normalized_hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def lookup(self, text: str, source_language: str, target_language: str):
+        return self.lookup_many([text], source_language, target_language).get(text)
+
+    def store_many(self, translations: Iterable[Tuple[str, str]], source_language: str, target_language: str):
+        """
+        :param translations: pairs of source text and translated text
+        :param source_language:
+        :param target_language:
+        """
+        rows = [(source_language, target_language, text, normalize(text), translated)
+                for text, translated in translations]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)', rows)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+_memory: Optional[TranslationMemory] = None
+_memory_lock = threading.Lock()
+
+
+def get_memory() -> TranslationMemory:
+    """
+    The memory on disk shared by the threads of the process
+    """
+    global _memory
+    with _memory_lock:
+        if _memory is None:
+            _memory = TranslationMemory()
+        return _memory
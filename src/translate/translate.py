@@ -1,45 +1,179 @@
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pprint import pprint
+from typing import Iterable, Iterator
 
-import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
 
+import services
 from dto import Item
-from utils import cache
+from instrumentation import count, gauge, span
+from translate.executor import AdaptiveExecutor, TaskFailed
+from translate.memory import TranslationMemory, get_memory
 
 
-@cache
-def translate_item(item: Item, source_language, target_language) -> Item:
-    if len(bytes(item.content(), "utf-8")) > 5000:
+class TranslationError(Exception):
+    """
+    Segments that could not be translated; `failed_segments` holds the error by segment index
+    """
+
+    def __init__(self, failed_segments: dict[int, Exception]):
+        self.failed_segments = failed_segments
+        segments = ', '.join(str(index) for index in sorted(failed_segments)[:20])
+        more = '' if len(failed_segments) <= 20 else f' and {len(failed_segments) - 20} more'
+        super().__init__(f'Translation failed for {len(failed_segments)} segments: {segments}{more}')
+
+
+def translate(text, current_language, target_language, translate_client=None):
+    if len(bytes(text, "utf-8")) > 5000:
         assert False, "Text is too long"
-    translate_client = boto3.client('translate')
-    translated_item = Item(
-        start_time=item.start_time,
-        end_time=item.end_time,
-        speaker_label=item.speaker_label
-    )
-    try:
+    translate_client = translate_client or services.client('translate')
+    count('aws.api_calls')
+    with span('aws.translate.translate_text'):
         response = translate_client.translate_text(
-            Text=item.content(),
-            SourceLanguageCode=source_language,
+            Text=text,
+            SourceLanguageCode=current_language,
             TargetLanguageCode=target_language,
         )
-        translated_item._content = response['TranslatedText']
-    except ClientError:
-        translated_item._content = 'error during translation'
-    return translated_item
+    return response['TranslatedText']
 
 
-def translate(text, current_language, target_language):
-    if len(bytes(text, "utf-8")) > 5000:
-        assert False, "Text is too long"
-    translate_client = boto3.client('translate')
-    response = translate_client.translate_text(
-        Text=text,
-        SourceLanguageCode=current_language,
-        TargetLanguageCode=target_language,
-    )
-    return response['TranslatedText']
+def translate_client_for(max_concurrency: int):
+    """
+    One client shared by the threads; botocore retries are off so throttling reaches the executor
+    """
+    config = Config(retries={'mode': 'standard', 'max_attempts': 1}, max_pool_connections=max_concurrency)
+    return services.client('translate', config=config)
+
+
+def translate_items(items: list[Item], source_language: str, target_language: str,
+                    memory: TranslationMemory = None, executor: AdaptiveExecutor = None) -> list[Item]:
+    """
+    Translate the items, sending only the texts missing in the translation memory to the Translate API
+    :param items:
+    :param source_language:
+    :param target_language:
+    :param memory: translation memory, the shared one on disk if not set
+    :param executor: executor of the API calls, a new AdaptiveExecutor if not set
+    :return: translated items in the same order
+    :raises TranslationError: with the failed segments; the successful translations are kept in the memory
+    """
+    if memory is None:
+        memory = get_memory()
+    if executor is None:
+        executor = AdaptiveExecutor()
+    texts = [item.content() for item in items]
+    translations = memory.lookup_many(texts, source_language, target_language)
+    count('translate.memory_hits', sum(1 for text in texts if text in translations))
+    missing = [text for text in dict.fromkeys(texts) if text not in translations and text.strip()]
+    if missing:
+        client = translate_client_for(executor.max_concurrency)
+        arguments = [(text, source_language, target_language, client) for text in missing]
+        failed_texts = {}
+        try:
+            translated_texts = executor.map(translate, arguments)
+        except TaskFailed as e:
+            translated_texts = e.results
+            failed_texts = {missing[index]: error for index, error in e.failed.items()}
+        new_translations = [(text, translated) for text, translated in zip(missing, translated_texts)
+                            if text not in failed_texts]
+        memory.store_many(new_translations, source_language, target_language)
+        translations.update(new_translations)
+        if failed_texts:
+            raise TranslationError({index: failed_texts[text] for index, text in enumerate(texts)
+                                    if text in failed_texts})
+
+    translated_items = []
+    for item, text in zip(items, texts):
+        translated_item = Item(start_time=item.start_time, end_time=item.end_time, speaker_label=item.speaker_label)
+        translated_item._content = translations.get(text, text)
+        translated_items.append(translated_item)
+    return translated_items
+
+
+def translate_stream(items: Iterable[Item], source_language: str, target_language: str,
+                     memory: TranslationMemory = None, executor: AdaptiveExecutor = None,
+                     max_pending: int = 256, lookup_batch: int = 64) -> Iterator[Item]:
+    """
+    Translate the items as they are read, e.g. from iter_subtitles: a text is sent to the Translate API
+    as soon as its item arrives and the translated items are yielded in the order of the items
+    :param items:
+    :param source_language:
+    :param target_language:
+    :param memory: translation memory, the shared one on disk if not set
+    :param executor: executor of the API calls, a new AdaptiveExecutor if not set
+    :param max_pending: items read ahead of the next one to yield, bounds the memory and the calls in flight
+    :param lookup_batch: items read at once, their texts are looked up in the memory with one query
+    :return: translated items, nothing is yielded after the first failed one
+    :raises TranslationError: once all the items are read, with the failed segments;
+        the successful translations are kept in the memory
+    """
+    if memory is None:
+        memory = get_memory()
+    if executor is None:
+        executor = AdaptiveExecutor()
+    client = None
+    translations: dict[str, str] = {}
+    futures = {}
+    new_translations = []
+    failed = {}
+    pending = deque()
+
+    def resolve(index: int, item: Item, text: str) -> Item:
+        future = futures.get(text)
+        if future is not None:
+            try:
+                translations[text] = future.result()
+            except Exception as e:
+                # the future is kept, the later items with the same text fail too
+                failed[index] = e
+                return item
+            new_translations.append((text, translations[text]))
+            del futures[text]
+        translated_item = Item(start_time=item.start_time, end_time=item.end_time, speaker_label=item.speaker_label)
+        translated_item._content = translations.get(text, text)
+        return translated_item
+
+    def is_ready(text: str) -> bool:
+        return text not in futures or futures[text].done()
+
+    try:
+        with ThreadPoolExecutor(max_workers=executor.max_concurrency) as pool:
+            iterator = iter(items)
+            index = 0
+            while True:
+                batch = list(islice(iterator, lookup_batch))
+                if not batch:
+                    break
+                new_texts = [text for text in dict.fromkeys(item.content() for item in batch)
+                             if text.strip() and text not in translations and text not in futures]
+                if new_texts:
+                    known = memory.lookup_many(new_texts, source_language, target_language)
+                    count('translate.memory_hits', len(known))
+                    translations.update(known)
+                for item in batch:
+                    text = item.content()
+                    if text.strip() and text not in translations and text not in futures:
+                        client = client or translate_client_for(executor.max_concurrency)
+                        futures[text] = executor.submit(pool, translate, (text, source_language, target_language,
+                                                                          client))
+                    pending.append((index, item, text))
+                    index += 1
+                    while pending and (len(pending) > max_pending or is_ready(pending[0][2])):
+                        translated_item = resolve(*pending.popleft())
+                        if not failed:
+                            yield translated_item
+            while pending:
+                translated_item = resolve(*pending.popleft())
+                if not failed:
+                    yield translated_item
+    finally:
+        memory.store_many(new_translations, source_language, target_language)
+    gauge('translate.concurrency_limit', executor.limiter.limit)
+    if failed:
+        raise TranslationError(failed)
 
 
 def translate_subtitle(subtitle_path):
@@ -4,16 +4,19 @@ import pickle
 from glob import glob
 from pathlib import Path
 
-import boto3
 from botocore.exceptions import ClientError
 
+import services
 from dto import AWSItem
+from instrumentation import count, span
 
 
 def check_s3_file(bucket_name, project_name):
-    s3_client = boto3.client('s3')
+    s3_client = services.client('s3')
     try:
-        return s3_client.head_object(Bucket=bucket_name, Key=project_name)
+        count('aws.api_calls')
+        with span('aws.s3.head_object'):
+            return s3_client.head_object(Bucket=bucket_name, Key=project_name)
     except ClientError:
         # Not found
         pass
@@ -21,11 +24,14 @@ def check_s3_file(bucket_name, project_name):
 
 
 def upload_file_to_s3(audio_path: str, bucket_name: str = 'lokoai-lambdas-demo'):
-    s3_client = boto3.client('s3')
+    s3_client = services.client('s3')
     project_name = Path(audio_path).name
     if not check_s3_file(bucket_name, project_name):
         print('uploading {} to s3'.format(project_name))
-        s3_client.upload_file(audio_path, bucket_name, project_name)
+        count('aws.api_calls')
+        count('aws.s3.bytes_uploaded', Path(audio_path).stat().st_size)
+        with span('aws.s3.upload_file'):
+            s3_client.upload_file(audio_path, bucket_name, project_name)
     return f's3://{bucket_name}/{project_name}'
 
 
@@ -35,10 +41,7 @@ def create_markdown(items: list[AWSItem]):
     :param items:
     :return:
     """
-    result = ''
-    for item in items:
-        result += f'{item.speaker_label}: {item.content()}\n\n'
-    return result
+    return ''.join(f'{item.speaker_label}: {item.content()}\n\n' for item in items)
 
 
 def cache(function):
@@ -49,6 +52,7 @@ def cache(function):
         Path('cache').mkdir(exist_ok=True)
         if not glob(f'cache/{function.__name__}_{h}.pickle'):
             logging.debug('Cache miss. Making new request.')
+            count(f'cache.{function.__name__}.misses')
             response = function(*args)
             logging.debug('Caching...')
             logging.debug(f'to cache/{function.__name__}_{h}.pickle')
@@ -56,6 +60,7 @@ def cache(function):
                 pickle.dump(response, f)
         else:
             logging.debug('Cache hit.')
+            count(f'cache.{function.__name__}.hits')
             logging.debug(f'from cache/{function.__name__}_{h}.pickle')
             with open(f'cache/{function.__name__}_{h}.pickle', 'rb') as f:
                 response = pickle.load(f)
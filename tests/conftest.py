@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules of the app import each other from src, as streamlit and the command line run them
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
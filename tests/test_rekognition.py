@@ -0,0 +1,131 @@
+import json
+import time
+
+import pytest
+
+from rekognition import CompletionDispatcher, InMemoryQueue, VideoDetect
+
+
+def create_dispatcher(**kwargs):
+    queue = InMemoryQueue()
+    return queue, CompletionDispatcher(queue, 'queue-url', **kwargs)
+
+
+def test_notifications_resolve_the_registered_jobs():
+    queue, dispatcher = create_dispatcher(wait_time_seconds=1)
+    first = dispatcher.register('job-1')
+    second = dispatcher.register('job-2')
+    queue.publish_completion('job-2', status='FAILED')
+    queue.publish_completion('job-1')
+
+    results = dispatcher.run_until_complete(timeout=5)
+
+    assert results['job-1']['Status'] == 'SUCCEEDED'
+    assert results['job-2']['Status'] == 'FAILED'
+    assert first.result() is results['job-1'] and second.result() is results['job-2']
+    assert dispatcher.pending() == []
+    assert len(queue) == 0
+
+
+def test_notification_received_before_the_job_is_registered():
+    queue, dispatcher = create_dispatcher(wait_time_seconds=1)
+    queue.publish_completion('job-1')
+    dispatcher.poll()
+
+    assert dispatcher.unclaimed() == ['job-1']
+    assert dispatcher.register('job-1').result(timeout=0)['Status'] == 'SUCCEEDED'
+    assert dispatcher.unclaimed() == []
+
+
+def test_unclaimed_notifications_are_capped():
+    queue, dispatcher = create_dispatcher(wait_time_seconds=0, max_unclaimed=2)
+    for job_id in ('job-1', 'job-2', 'job-3'):
+        queue.publish_completion(job_id)
+    dispatcher.poll()
+
+    assert dispatcher.unclaimed() == ['job-2', 'job-3']
+
+
+def test_unclaimed_notifications_expire():
+    queue, dispatcher = create_dispatcher(wait_time_seconds=0, unclaimed_ttl=0.05)
+    queue.publish_completion('job-1')
+    dispatcher.poll()
+    time.sleep(0.1)
+    queue.publish_completion('job-2')
+    dispatcher.poll()
+
+    assert dispatcher.unclaimed() == ['job-2']
+
+
+def test_unexpected_messages_are_skipped_and_deleted():
+    queue, dispatcher = create_dispatcher(wait_time_seconds=0)
+    queue.send_message('queue-url', 'not json')
+    queue.send_message('queue-url', json.dumps({'Type': 'Notification'}))
+
+    assert dispatcher.poll() == 2
+    assert dispatcher.unclaimed() == []
+    assert len(queue) == 0
+
+
+def test_timeout_does_not_wait_for_a_full_long_poll():
+    _, dispatcher = create_dispatcher(wait_time_seconds=20)
+    dispatcher.register('job-1')
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        dispatcher.run_until_complete(timeout=1)
+    assert time.monotonic() - started < 5
+
+
+def test_background_polling():
+    queue, dispatcher = create_dispatcher(wait_time_seconds=1)
+    future = dispatcher.register('job-1')
+    dispatcher.start()
+    try:
+        queue.publish_completion('job-1')
+        assert future.result(timeout=5)['JobId'] == 'job-1'
+    finally:
+        dispatcher.stop()
+
+
+class FakeRekognition:
+    """
+    get_label_detection of jobs given as {JobId: (JobStatus, labels)}
+    """
+
+    def __init__(self, jobs: dict):
+        self.jobs = jobs
+
+    def get_label_detection(self, JobId, MaxResults, **kwargs):
+        status, labels = self.jobs[JobId]
+        response = {'JobStatus': status, 'Labels': labels}
+        if status == 'SUCCEEDED':
+            response['VideoMetadata'] = {'FrameRate': 25.0}
+        return response
+
+
+def label(timestamp: int, name: str) -> dict:
+    return {'Timestamp': timestamp, 'Label': {'Name': name, 'Confidence': 90.0, 'Instances': []}}
+
+
+def test_concurrent_jobs_are_collected_by_job_id(tmp_path):
+    rek = FakeRekognition({'job-1': ('SUCCEEDED', [label(0, 'Car')]),
+                           'job-2': ('SUCCEEDED', [label(40, 'Dog'), label(80, 'Dog')])})
+    analyzer = VideoDetect('role', 'bucket', 'video.mp4', rek=rek, sqs=InMemoryQueue(), sns=object())
+
+    first = analyzer.CollectLabelDetections('job-1', cache_folder=tmp_path)
+    second = analyzer.CollectLabelDetections('job-2', cache_folder=tmp_path)
+
+    assert first['name'].tolist() == ['Car']
+    assert second['name'].tolist() == ['Dog', 'Dog']
+    assert json.loads((tmp_path / 'labels-job-2.json').read_text()) == {'FrameRate': 25.0}
+
+
+@pytest.mark.parametrize('status', ['IN_PROGRESS', 'FAILED'])
+def test_unfinished_jobs_are_not_cached(tmp_path, status):
+    rek = FakeRekognition({'job-1': (status, [])})
+    analyzer = VideoDetect('role', 'bucket', 'video.mp4', rek=rek, sqs=InMemoryQueue(), sns=object())
+
+    with pytest.raises(RuntimeError, match=status):
+        analyzer.CollectLabelDetections('job-1', cache_folder=tmp_path)
+    assert list(tmp_path.iterdir()) == []